@@ -0,0 +1,121 @@
+import hashlib
+import json
+
+import numpy as np
+import os
+import tensorflow.compat.v1 as tf
+
+tf.disable_v2_behavior()
+
+from bucketing import bucket_of, make_batches, BucketedSequence
+
+
+def weights_fingerprint(model):
+    hasher = hashlib.sha1()
+    for weights in model.get_weights():
+        hasher.update(np.ascontiguousarray(weights).tobytes())
+    return hasher.hexdigest()
+
+
+def cache_encoder_outputs(encoder, inputs, cache_dir, batch_size, bucket_lengths=None, with_sequence=True,
+                          max_seq_length=512):
+    """Runs the frozen encoder once over inputs and stores its outputs as float16 npy files under cache_dir.
+
+    encoder maps [input_ids, input_masks, segment_ids] to [pooled_output, sequence_output]. The pooled outputs
+    are kept as an (N, hidden) array; the sequence outputs, if with_sequence is set, without their padding as
+    one (total tokens, hidden) array plus the row offset of every example. The cache is keyed by a fingerprint
+    of the encoder weights and reused as long as they do not change. Returns the loaded (memory-mapped) cache.
+    """
+    fingerprint = weights_fingerprint(encoder)
+    manifest_fname = os.path.join(cache_dir, 'manifest.json')
+    if os.path.isfile(manifest_fname):
+        with open(manifest_fname, 'r') as fin:
+            manifest = json.load(fin)
+        if manifest['fingerprint'] == fingerprint and manifest['num_examples'] == len(inputs[0]) \
+                and (manifest['with_sequence'] or not with_sequence):
+            return load_encoder_outputs(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.isfile(manifest_fname):
+        os.remove(manifest_fname)
+
+    lengths = np.asarray(inputs[1]).sum(axis=1).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    np.save(os.path.join(cache_dir, 'offsets.npy'), offsets)
+    pooled, sequence = None, None
+    # trimmed batches if the encoder takes variable lengths, the sequence outputs are cut to each example anyway
+    sequence_batches = BucketedSequence(inputs, None, bucket_lengths or [max_seq_length], batch_size)
+    for i, (_, index) in enumerate(sequence_batches.batches):
+        batch_pooled, batch_sequence = encoder.predict_on_batch(sequence_batches[i])
+        if pooled is None:
+            pooled = np.lib.format.open_memmap(os.path.join(cache_dir, 'pooled_output.npy'), mode='w+',
+                                               dtype=np.float16, shape=(len(lengths), batch_pooled.shape[-1]))
+            if with_sequence:
+                sequence = np.lib.format.open_memmap(os.path.join(cache_dir, 'sequence_output.npy'), mode='w+',
+                                                     dtype=np.float16,
+                                                     shape=(offsets[-1], batch_sequence.shape[-1]))
+        pooled[index] = batch_pooled
+        if with_sequence:
+            for row, example_id in enumerate(index):
+                sequence[offsets[example_id]: offsets[example_id + 1]] = batch_sequence[row, :lengths[example_id]]
+        print('\rcaching encoder outputs: {}/{} batches'.format(i + 1, len(sequence_batches)), end='')
+    print()
+    for output in (pooled, sequence):
+        if output is not None:
+            output.flush()
+    with open(manifest_fname, 'w') as fout:
+        json.dump({'fingerprint': fingerprint, 'num_examples': len(lengths), 'with_sequence': with_sequence}, fout)
+    return load_encoder_outputs(cache_dir)
+
+
+def load_encoder_outputs(cache_dir):
+    cache = {'offsets': np.load(os.path.join(cache_dir, 'offsets.npy')),
+             'pooled_output': np.load(os.path.join(cache_dir, 'pooled_output.npy'), mmap_mode='r')}
+    if os.path.isfile(os.path.join(cache_dir, 'sequence_output.npy')):
+        cache['sequence_output'] = np.load(os.path.join(cache_dir, 'sequence_output.npy'), mmap_mode='r')
+    return cache
+
+
+class CachedActivationSequence(tf.keras.utils.Sequence):
+    """Batches of cached encoder outputs for training a head model without running BERT.
+
+    For the classifier head (head='cls') a batch is the pooled outputs; for the explainer head (head='exp') it is
+    [sequence outputs, input masks], padded to the bucket length of the batch. Token level targets are cut to
+    the same length, see bucketing.BucketedSequence.
+    """
+
+    def __init__(self, cache, input_masks, outputs, head, bucket_lengths, batch_size, shuffle=False, seed=None):
+        self.cache = cache
+        self.input_masks = input_masks
+        self.outputs = outputs
+        self.head = head
+        self.bucket_lengths = bucket_lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buckets = bucket_of(input_masks, bucket_lengths)
+        self.random_state = np.random.RandomState(seed)
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        return make_batches(self.buckets, self.bucket_lengths, self.batch_size, self.shuffle, self.random_state)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, i):
+        length, index = self.batches[i]
+        if self.head == 'cls':
+            x = np.asarray(self.cache['pooled_output'][index], dtype=np.float32)
+            y = np.asarray(self.outputs[index])
+            return x, y
+        offsets, sequence_output = self.cache['offsets'], self.cache['sequence_output']
+        x = np.zeros((len(index), length, sequence_output.shape[-1]), dtype=np.float32)
+        for row, example_id in enumerate(index):
+            example_output = sequence_output[offsets[example_id]: offsets[example_id + 1]]
+            x[row, :len(example_output)] = example_output
+        masks = np.asarray(self.input_masks[index])[:, :length]
+        y = np.asarray(self.outputs[index])[:, :length]
+        return [x, masks], y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.batches = self._make_batches()
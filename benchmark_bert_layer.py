@@ -0,0 +1,118 @@
+"""Per-batch latency and peak memory of BertLayer, with one module application per call (current) against the
+former two (one for pooled_output, one for sequence_output). Every variant runs in its own process on CPU, so
+that the peak resident set sizes do not mix.
+
+    python benchmark_bert_layer.py --batch_size 8 --seq_length 512 --num_batches 10
+"""
+import argparse
+import json
+import re
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import os
+
+VARIANTS = ['double', 'single']
+
+
+def _double_forward_layer():
+    import tensorflow.compat.v1 as tf
+    from tensorflow.keras import backend as K
+    from model import BertLayer
+
+    class DoubleForwardBertLayer(BertLayer):
+        # BertLayer.call before the module was applied only once
+        def call(self, inputs):
+            inputs = [K.cast(x, dtype="int32") for x in inputs]
+            input_ids, input_mask, segment_ids = inputs
+            bert_inputs = dict(
+                input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids
+            )
+            cls = self.bert(inputs=bert_inputs, signature="tokens",
+                            as_dict=True)["pooled_output"]
+            exp = self.bert(inputs=bert_inputs, signature="tokens",
+                            as_dict=True)["sequence_output"]
+
+            def mul_mask(x, m): return x * tf.expand_dims(m, axis=-1)
+
+            input_mask = tf.cast(input_mask, tf.float32)
+            exp = mul_mask(exp, input_mask)
+            return [cls, exp]
+
+    return DoubleForwardBertLayer
+
+
+def run_variant(variant, bert_path, batch_size, seq_length, num_batches, num_threads):
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+    from tensorflow.compat.v1.keras.layers import Input
+    from tensorflow.compat.v1.keras.models import Model
+    from model import BertLayer
+
+    config = tf.ConfigProto(device_count={'GPU': 0},
+                            intra_op_parallelism_threads=num_threads,
+                            inter_op_parallelism_threads=num_threads)
+    sess = tf.Session(config=config)
+    tf.keras.backend.set_session(sess)
+    layer_cls = _double_forward_layer() if variant == 'double' else BertLayer
+    inputs = [Input(shape=(seq_length,), name=name) for name in ['input_ids', 'input_masks', 'segment_ids']]
+    model = Model(inputs=inputs, outputs=layer_cls(bert_path=bert_path, name='bert')(inputs))
+    sess.run(tf.global_variables_initializer())
+    sess.run(tf.tables_initializer())
+    # every application of a hub.Module gets its own '<module>_apply_tokens[_i]' name scope
+    module_applications = len(set(re.search(r'[^/]*apply_tokens[^/]*', op.name).group()
+                                  for op in sess.graph.get_operations() if 'apply_tokens' in op.name))
+
+    rng = np.random.RandomState(0)
+    input_ids = rng.randint(1000, 2000, (batch_size, seq_length))
+    input_masks = np.ones((batch_size, seq_length))
+    segment_ids = np.zeros((batch_size, seq_length))
+    batch = [input_ids, input_masks, segment_ids]
+    model.predict_on_batch(batch)  # warm up
+    latencies = []
+    for _ in range(num_batches):
+        start = time.perf_counter()
+        model.predict_on_batch(batch)
+        latencies.append(time.perf_counter() - start)
+    return {'variant': variant,
+            'module_applications': module_applications,
+            'graph_ops': len(sess.graph.get_operations()),
+            'median_latency_s': float(np.median(latencies)),
+            'mean_latency_s': float(np.mean(latencies)),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bert_path', type=str, default="https://tfhub.dev/google/bert_uncased_L-12_H-768_A-12/1")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--seq_length', type=int, default=512)
+    parser.add_argument('--num_batches', type=int, default=10)
+    parser.add_argument('--num_threads', type=int, default=os.cpu_count())
+    parser.add_argument('--variant', type=str, default=None, choices=VARIANTS)  # internal: run one variant
+    args = parser.parse_args()
+
+    if args.variant is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        print(json.dumps(run_variant(args.variant, args.bert_path, args.batch_size, args.seq_length,
+                                     args.num_batches, args.num_threads)))
+        sys.exit(0)
+
+    results = []
+    for variant in VARIANTS:
+        output = subprocess.run([sys.executable, __file__, '--variant', variant,
+                                 '--bert_path', args.bert_path,
+                                 '--batch_size', str(args.batch_size),
+                                 '--seq_length', str(args.seq_length),
+                                 '--num_batches', str(args.num_batches),
+                                 '--num_threads', str(args.num_threads)],
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    print('| variant | module applications | graph ops | median latency / batch | peak RSS |')
+    print('|---------|---------------------|-----------|------------------------|----------|')
+    for res in results:
+        print('| {variant} | {module_applications} | {graph_ops} | {median_latency_s:.3f}s | {peak_rss_mb:.0f}MB |'
+              .format(**res))
@@ -8,7 +8,7 @@ from tensorflow.python.keras.backend import set_session
 from tqdm import tqdm
 
 from display_rational import convert_res_to_htmls
-from eraser_benchmark import rnr_matrix_to_rational_mask
+from eraser_benchmark import rnr_matrices_to_rational_masks, predict_rnr_rational_masks
 from losses import imbalanced_bce_bayesian, imbalanced_bce_resampling
 from losses import rnr_matrix_loss
 from metrices import *
@@ -60,9 +60,20 @@ if __name__ == '__main__':
     parser.add_argument('--save_machine_rationale', action='store_true')
     parser.add_argument('--machine_rationale_folder', type=str, default='eraserbenchmark/machine_rationale')
     parser.add_argument('--load_phase1', action='store_true')
+    parser.add_argument('--cache_phase1_activations', action='store_true')  # phase 1 heads train on cached BERT outputs
     parser.add_argument('--force_recache', action='store_true')
+    parser.add_argument('--preprocess_workers', type=int, default=1)
+    parser.add_argument('--incremental_preprocess', action='store_true')  # only re-tokenize new or changed annotations
+    parser.add_argument('--vocab_file', type=str, default=None)  # local BERT vocab, see bert_utils.resolve_vocab
+    parser.add_argument('--vocab_from_hub', action='store_true')  # no local vocab: read it from the Hub module
     parser.add_argument('--pooling', type=str, default='first', choices=['first', 'mean'])
+    parser.add_argument('--length_buckets', type=str, default=None)  # e.g. 128,256,384: batches cut to these lengths
+    parser.add_argument('--use_tf_data', action='store_true')  # stream batches from the feature store with tf.data
+    parser.add_argument('--tfrecord_dir', type=str, default=None)  # with --use_tf_data: read tfrecord_features shards
+    parser.add_argument('--benchmark_chunk_size', type=int, default=256)  # examples predicted and written at a time
+    parser.add_argument('--aopc_thresholds', type=str, default='0.01,0.05,0.1,0.2,0.5')  # '' skips the AOPC bins
     parser.add_argument('--cache_dir', type=str, default='/tmp/interpretation_by_design')
+    parser.add_argument('--cache_max_gb', type=float, default=50)  # LRU limit of feature caches and row stores
     parser.add_argument('--bert_size', type=str, default='base', choices=['base', 'large'])
     parser.add_argument('--rebalance_approach', type=str, default='resampling', choices=['resampling', 'bayesian'])
     parser.add_argument('--data_dir', type=str)
@@ -116,9 +127,22 @@ if __name__ == '__main__':
     exp_only = args.exp_only
     eval_annotations = args.eval_annotations
     force_recache = args.force_recache
+    preprocess_workers = args.preprocess_workers
+    if args.vocab_file is not None:
+        os.environ['BERT_VOCAB_FILE'] = args.vocab_file  # read by the tokenizer factory, also in worker processes
+    if args.vocab_from_hub:
+        os.environ['BERT_VOCAB_FROM_HUB'] = '1'
     annotation_source = args.annotation_source
     machine_rationale_folder = args.machine_rationale_folder
     eval_on_explanation_only = args.eval_on_explanation_only
+    from bucketing import parse_bucket_lengths, length_normalized_loss, fit_model, evaluate_model, predict_model
+
+    LENGTH_BUCKETS = parse_bucket_lengths(args.length_buckets, MAX_SEQ_LENGTH)
+    BENCHMARK_CHUNK_SIZE = args.benchmark_chunk_size
+    AOPC_THRESHOLDS = [float(threshold) for threshold in args.aopc_thresholds.split(',') if threshold]
+    use_tf_data = args.use_tf_data
+    cache_phase1_activations = args.cache_phase1_activations
+    assert not (LENGTH_BUCKETS is not None and exp_structure == 'rnr')  # the rnr end head is a Dense(MAX_SEQ_LENGTH)
     assert (not (freeze_cls and freeze_exp))
     assert (not (train_exp_first and train_cls_first))
     assert not ((freeze_cls or freeze_exp) and (
@@ -245,10 +269,36 @@ if __name__ == '__main__':
     docids = set(chain.from_iterable(extract_doc_ids_from_annotations(d) for d in [train, val, test]))
     docs = load_documents(data_dir, docids)
 
-    from bert_data_preprocessing_rational_eraser import preprocess
+    from bert_data_preprocessing_rational_eraser import preprocess, preprocess_incremental, unpack_rations, \
+        PREPROCESSING_VERSION
+    from bert_utils import resolve_vocab
 
-
-    @cache_decorator(os.path.join(cache_dir, 'cache', data_cache_name + '_eraser_format'), force_recache=force_recache)
+    # the cache is addressed by the content of everything the features depend on, not only by the flags
+    data_files = [os.path.join(data_dir, fname) for fname in ['train.jsonl', 'val.jsonl', 'test.jsonl']]
+    if os.path.exists(os.path.join(data_dir, 'docs.jsonl')):
+        data_files.append(os.path.join(data_dir, 'docs.jsonl'))
+    else:
+        data_files.append(os.path.join(data_dir, 'docs'))
+    data_files.append(resolve_vocab(session_config=config)[0])
+    cache_key = content_cache_key(data_files,
+                                  {'max_seq_length': MAX_SEQ_LENGTH,
+                                   'dataset': dataset,
+                                   'exp_structure': exp_structure,
+                                   'training_data_decorator': getattr(training_data_decorator, '__name__', None),
+                                   'eval_on_explanation_only': eval_on_explanation_only,
+                                   'train_on_portion': train_on_portion,
+                                   'merge_evidences': merge_evidences},
+                                  PREPROCESSING_VERSION)
+    data_cache_dir = os.path.join(cache_dir, 'cache', data_cache_name + '_' + cache_key)
+
+
+    row_store_entries = []
+
+    # compact numpy features with bit-packed rationale masks, one memory-mapped shard per split and field
+    @npy_cache_decorator(data_cache_dir,
+                         split_names=['train', 'val', 'test'],
+                         field_names=['input_ids', 'input_masks', 'segment_ids', 'rations', 'labels'],
+                         force_recache=force_recache)
     def preprocess_wrapper(*data_inputs, docs=docs):
         data_decorators = [training_data_decorator, None]
         if eval_on_explanation_only:
@@ -256,34 +306,51 @@ if __name__ == '__main__':
         else:
             data_decorators.append(None)
         ret = []
-        for data, decorator in zip(data_inputs, data_decorators):
-            ret.append(
-                preprocess(data, docs, label_list, dataset,
-                           MAX_SEQ_LENGTH, exp_structure, merge_evidences,
-                           data_decorator=decorator, gpu_id=gpu_id)
-            )
+        for data, decorator, split_name in zip(data_inputs, data_decorators, ['train', 'val', 'test']):
+            if args.incremental_preprocess:
+                # per-annotation rows, reused across edits of the dataset as long as these settings hold
+                row_settings_key = content_cache_key([resolve_vocab(session_config=config)[0]],
+                                                     {'max_seq_length': MAX_SEQ_LENGTH,
+                                                      'dataset': dataset,
+                                                      'exp_structure': exp_structure,
+                                                      'data_decorator': getattr(decorator, '__name__', None),
+                                                      'merge_evidences': merge_evidences},
+                                                     PREPROCESSING_VERSION)
+                row_store_entry = os.path.join(cache_dir, 'rows', '{}_{}'.format(dataset, row_settings_key))
+                row_store_entries.append(row_store_entry)
+                row_store_dir = os.path.join(row_store_entry, split_name)
+                ret.append(
+                    preprocess_incremental(data, docs, label_list, dataset,
+                                           MAX_SEQ_LENGTH, exp_structure, merge_evidences, row_store_dir,
+                                           data_decorator=decorator, gpu_id=gpu_id, num_workers=preprocess_workers)
+                )
+            else:
+                ret.append(
+                    preprocess(data, docs, label_list, dataset,
+                               MAX_SEQ_LENGTH, exp_structure, merge_evidences,
+                               data_decorator=decorator, gpu_id=gpu_id, num_workers=preprocess_workers)
+                )
+            # every example must hold both the query and the document [SEP]
+            if np.any(np.sum(ret[-1][0] == 102, axis=1) < 2):
+                raise ValueError
         return ret
 
 
     rets_train, rets_val, rets_test = preprocess_wrapper(train, val, test, docs=docs)
+    # the incremental row stores count towards the same limit
+    evict_cache_entries([os.path.join(cache_dir, 'cache'), os.path.join(cache_dir, 'rows')],
+                        args.cache_max_gb * (1 << 30), keep=[data_cache_dir] + row_store_entries)
 
     train_input_ids, train_input_masks, train_segment_ids, train_rations, train_labels = rets_train
     val_input_ids, val_input_masks, val_segment_ids, val_rations, val_labels = rets_val
     test_input_ids, test_input_masks, test_segment_ids, test_rations, test_labels = rets_test
+    if use_tf_data and BENCHMARK_SPLIT_NAME != 'train' and not cache_phase1_activations:
+        train_rations = None  # unpacked batch by batch in the input pipeline
+    train_rations, val_rations, test_rations = [None if rations is None else unpack_rations(rations, exp_structure)
+                                                for rations in (train_rations, val_rations, test_rations)]
 
     print(test_input_ids[0])
 
-    for i, input_ids in enumerate([train_input_ids, val_input_ids, test_input_ids]):
-        for j, ids in enumerate(input_ids):
-            try:
-                a = ids[ids.index(102) + 1:].index(102)
-            except ValueError:
-                #print("$"*100)
-                #print(i, j)
-                #print(ids)
-                #print(train[j])
-                raise ValueError
-
 
     def expand_on_evidences(data):
         from eraserbenchmark.rationale_benchmark.utils import Annotation
@@ -346,24 +413,82 @@ if __name__ == '__main__':
                                  precision_wrapper(exp_structure),
                                  recall_wrapper(exp_structure)]
         loss['exp_output'] = loss_function()
+        if LENGTH_BUCKETS is not None:
+            loss['exp_output'] = length_normalized_loss(loss['exp_output'], MAX_SEQ_LENGTH)
+
+
+    def build_heads():
+        # the heads as functions of the BERT outputs; their layers are created once, so a head applied again,
+        # e.g. to cached BERT activations, shares its weights with the full model
+        cls_dense = Dense(DIM_DENSE_CLS, activation='tanh', name='cls_dense')
+        cls_dense_output = Dense(1, activation='sigmoid', name='cls_output')
+
+        def cls_head(bert_cls_output):
+            return cls_dense_output(cls_dense(bert_cls_output))
+
+        if exp_structure == 'gru':
+            gru = CuDNNGRU(
+                NUM_GRU_UNITS_BERT_SEQ, kernel_initializer='random_uniform', return_sequences=True,
+                name='exp_gru_gru')
+            exp_dense = Dense(1, activation='sigmoid', name='exp_gru_dense')
+            exp_reshape = Reshape((-1, 1), name='exp_gru_reshape')
+            exp_multiply = Multiply(name='exp_output')
+
+            def exp_head(bert_exp_output, in_mask):
+                exp = exp_dense(gru(bert_exp_output))
+                output_mask = exp_reshape(in_mask)
+                return exp_multiply([output_mask, exp])
+        elif exp_structure == 'rnr':
+            lstm1 = Bidirectional(
+                layer=CuDNNLSTM(NUM_INTERVAL_LSTM_WIDTH, return_sequences=True, name='exp_rnr_lstm1'),
+                merge_mode='concat', name='exp_rnr_bidirectional1')
+            starts = Dense(1, activation='sigmoid', name='exp_rnr_starts')
+            lstm2 = Bidirectional(
+                layer=CuDNNLSTM(NUM_INTERVAL_LSTM_WIDTH, return_sequences=True, name='exp_rnr_lstm2'),
+                merge_mode='concat', name='exp_rnr_bidirecitonal2')
+            end = Dense(MAX_SEQ_LENGTH, activation='linear', name='exp_rnr_end')
+            exp_concatenate = Concatenate(axis=-1, name='exp_output')
+
+            def exp_head(bert_exp_output, in_mask):
+                M1 = lstm1(bert_exp_output)
+                p_starts = starts(Concatenate(axis=-1)([bert_exp_output, M1]))
+                start_mask = Reshape((MAX_SEQ_LENGTH, 1))(in_mask)
+                p_starts = Multiply()([p_starts, start_mask])
+
+                m1_tilde = Dot(axes=-2)([p_starts, M1])
+                M1_tilde = Lambda(lambda x: tf.tile(x, (1, MAX_SEQ_LENGTH, 1)))(m1_tilde)
+                x = Multiply()([M1, M1_tilde])
+                M2 = lstm2(Concatenate(axis=-1)([bert_exp_output, M1, M1_tilde, x]))
+                p_end_given_start = end(Concatenate(axis=-1)([bert_exp_output, M2]))
+                end_mask = Lambda(lambda x: tf.tile(x, (1, MAX_SEQ_LENGTH, 1)))(Reshape((1, MAX_SEQ_LENGTH))(in_mask))
+                p_end_given_start = Multiply()([p_end_given_start, end_mask])
+                p_end_given_start = Lambda(lambda x: tf.linalg.band_part(x, 0, -1))(p_end_given_start)
+                p_end_given_start = Softmax(axis=-1)(p_end_given_start)
+
+                return exp_concatenate([p_starts, p_end_given_start])
+        else:
+            exp_head = None
+        return cls_head, exp_head
 
 
     def build_model():
-        in_id = Input(shape=(MAX_SEQ_LENGTH,), name="input_ids")
-        in_mask = Input(shape=(MAX_SEQ_LENGTH,), name="input_masks")
-        in_segment = Input(shape=(MAX_SEQ_LENGTH,), name="segment_ids")
+        # with length buckets the batches come in several lengths, up to MAX_SEQ_LENGTH
+        input_length = MAX_SEQ_LENGTH if LENGTH_BUCKETS is None else None
+        in_id = Input(shape=(input_length,), name="input_ids")
+        in_mask = Input(shape=(input_length,), name="input_masks")
+        in_segment = Input(shape=(input_length,), name="segment_ids")
         bert_inputs = [in_id, in_mask, in_segment]
 
         bert_cls_output, bert_exp_output = BertLayer(
             n_fine_tune_layers=10, name='bert')(bert_inputs)
+        cls_head, exp_head = build_heads()
 
         outputs = []
         model_cls, model_exp = None, None
 
         if 'seq' not in dataset and not exp_only:
             # Classifier output
-            dense = Dense(DIM_DENSE_CLS, activation='tanh', name='cls_dense')(bert_cls_output)
-            cls_output = Dense(1, activation='sigmoid', name='cls_output')(dense)
+            cls_output = cls_head(bert_cls_output)
             outputs.append(cls_output)
             model_cls = Model(inputs=bert_inputs, outputs=cls_output)
             optimizer = Adam(LEARNING_RATE)
@@ -373,38 +498,7 @@ if __name__ == '__main__':
 
         if 'cls' not in dataset and exp_structure != 'none' and not cls_only:
             # Explainer output
-            if exp_structure == 'gru':
-                gru = CuDNNGRU(
-                    NUM_GRU_UNITS_BERT_SEQ, kernel_initializer='random_uniform', return_sequences=True,
-                    name='exp_gru_gru')(
-                    bert_exp_output)
-                exp = Dense(1, activation='sigmoid', name='exp_gru_dense')(gru)
-                output_mask = Reshape((MAX_SEQ_LENGTH, 1), name='exp_gru_reshape')(in_mask)
-                exp_outputs = Multiply(name='exp_output')([output_mask, exp])
-            elif exp_structure == 'rnr':
-                M1 = Bidirectional(
-                    layer=CuDNNLSTM(NUM_INTERVAL_LSTM_WIDTH, return_sequences=True, name='exp_rnr_lstm1'),
-                    merge_mode='concat', name='exp_rnr_bidirectional1')(bert_exp_output)
-                p_starts = Dense(1, activation='sigmoid', name='exp_rnr_starts')(
-                    Concatenate(axis=-1)([bert_exp_output, M1]))
-                start_mask = Reshape((MAX_SEQ_LENGTH, 1))(in_mask)
-                p_starts = Multiply()([p_starts, start_mask])
-
-                m1_tilde = Dot(axes=-2)([p_starts, M1])
-                M1_tilde = Lambda(lambda x: tf.tile(x, (1, MAX_SEQ_LENGTH, 1)))(m1_tilde)
-                x = Multiply()([M1, M1_tilde])
-                M2 = Bidirectional(
-                    layer=CuDNNLSTM(NUM_INTERVAL_LSTM_WIDTH, return_sequences=True, name='exp_rnr_lstm2'),
-                    merge_mode='concat', name='exp_rnr_bidirecitonal2')(
-                    Concatenate(axis=-1)([bert_exp_output, M1, M1_tilde, x]))
-                p_end_given_start = Dense(MAX_SEQ_LENGTH, activation='linear', name='exp_rnr_end')(
-                    Concatenate(axis=-1)([bert_exp_output, M2]))
-                end_mask = Lambda(lambda x: tf.tile(x, (1, MAX_SEQ_LENGTH, 1)))(Reshape((1, MAX_SEQ_LENGTH))(in_mask))
-                p_end_given_start = Multiply()([p_end_given_start, end_mask])
-                p_end_given_start = Lambda(lambda x: tf.linalg.band_part(x, 0, -1))(p_end_given_start)
-                p_end_given_start = Softmax(axis=-1)(p_end_given_start)
-
-                exp_outputs = Concatenate(axis=-1, name='exp_output')([p_starts, p_end_given_start])
+            exp_outputs = exp_head(bert_exp_output, in_mask)
             outputs.append(exp_outputs)
             model_exp = Model(inputs=bert_inputs, outputs=exp_outputs)
             optimizer = Adam(LEARNING_RATE)
@@ -415,8 +509,9 @@ if __name__ == '__main__':
         model = Model(inputs=bert_inputs, outputs=outputs)
         optimizer = Adam(LEARNING_RATE)
         model.compile(loss=loss, loss_weights=loss_weights, optimizer=optimizer, metrics=metrics)
+        encoder = Model(inputs=bert_inputs, outputs=[bert_cls_output, bert_exp_output])
 
-        return model, model_cls, model_exp
+        return model, model_cls, model_exp, (encoder, cls_head, exp_head)
 
 
     # training, evaluation and inference
@@ -433,7 +528,7 @@ if __name__ == '__main__':
 
     with graph.as_default():
         set_session(sess)
-        model, model_cls, model_exp = build_model()
+        model, model_cls, model_exp, (encoder, cls_head, exp_head) = build_model()
         if exp_structure == 'none':
             model = model_cls
         model.summary()
@@ -456,6 +551,68 @@ if __name__ == '__main__':
             test_outputs['exp_output'] = test_rations
             val_outputs['exp_output'] = val_rations
 
+        def output_names_of(model):
+            return model.output_names[0] if len(model.output_names) == 1 else model.output_names
+
+        def split_dataset(split_name, split, output_names, shuffle=False):
+            if args.tfrecord_dir is not None:
+                from tfrecord_features import tfrecord_dataset
+                return tfrecord_dataset(args.tfrecord_dir, split_name, output_names, BATCH_SIZE, exp_structure,
+                                        shuffle=shuffle, bucket_lengths=LENGTH_BUCKETS, max_seq_length=MAX_SEQ_LENGTH)
+            from input_pipeline import feature_dataset
+            return feature_dataset(split, output_names, BATCH_SIZE, exp_structure,
+                                   shuffle=shuffle, bucket_lengths=LENGTH_BUCKETS, max_seq_length=MAX_SEQ_LENGTH)
+
+        def fit(model, outputs, validation_outputs, **kwargs):
+            if use_tf_data:
+                dataset, steps = split_dataset('train', rets_train, output_names_of(model), shuffle=True)
+                val_dataset, val_steps = split_dataset('val', rets_val, output_names_of(model))
+                return model.fit(dataset, steps_per_epoch=steps,
+                                 validation_data=val_dataset, validation_steps=val_steps, **kwargs)
+            return fit_model(model, training_inputs, outputs,
+                             validation_data=(val_inputs, validation_outputs),
+                             bucket_lengths=LENGTH_BUCKETS, batch_size=BATCH_SIZE, **kwargs)
+
+        def fit_head_on_cached_activations(head, outputs, validation_outputs, **kwargs):
+            # the encoder is frozen in phase 1: run it once, then train the head alone on its cached outputs
+            from activation_cache import cache_encoder_outputs, CachedActivationSequence
+            with_sequence = (head == 'exp')
+            caches = [cache_encoder_outputs(encoder, split_inputs, os.path.join(output_dir, 'phase1', 'activations',
+                                                                                split_name),
+                                            BATCH_SIZE, LENGTH_BUCKETS, with_sequence, MAX_SEQ_LENGTH)
+                      for split_name, split_inputs in [('train', training_inputs), ('val', val_inputs)]]
+            hidden_size = int(encoder.outputs[0].shape[-1])
+            if head == 'cls':
+                in_pooled = Input(shape=(hidden_size,), name='pooled_output')
+                head_model = Model(inputs=in_pooled, outputs=cls_head(in_pooled))
+                head_loss = loss['cls_output']
+                head_buckets = [MAX_SEQ_LENGTH]
+            else:
+                # the rnr head needs full length inputs, the gru head runs on length buckets
+                sequence_length = MAX_SEQ_LENGTH if exp_structure == 'rnr' else None
+                in_sequence = Input(shape=(sequence_length, hidden_size), name='sequence_output')
+                in_head_mask = Input(shape=(sequence_length,), name='input_masks')
+                head_model = Model(inputs=[in_sequence, in_head_mask], outputs=exp_head(in_sequence, in_head_mask))
+                if exp_structure == 'rnr':
+                    head_loss = loss['exp_output']
+                    head_buckets = [MAX_SEQ_LENGTH]
+                else:
+                    head_loss = length_normalized_loss(loss_function(), MAX_SEQ_LENGTH)
+                    head_buckets = LENGTH_BUCKETS or parse_bucket_lengths('128,256,384', MAX_SEQ_LENGTH)
+            head_model.compile(loss=head_loss, optimizer=Adam(LEARNING_RATE), metrics=[metrics[head + '_output']])
+            return head_model.fit(
+                CachedActivationSequence(caches[0], train_input_masks, outputs, head, head_buckets, BATCH_SIZE,
+                                         shuffle=True),
+                validation_data=CachedActivationSequence(caches[1], val_input_masks, validation_outputs, head,
+                                                         head_buckets, BATCH_SIZE),
+                **kwargs)
+
+        def evaluate_on_test(model):
+            if use_tf_data:
+                dataset, steps = split_dataset('test', rets_test, output_names_of(model))
+                return model.evaluate(dataset, steps=steps, verbose=1)
+            return evaluate_model(model, test_inputs, test_outputs, LENGTH_BUCKETS, BATCH_SIZE, verbose=1)
+
         initial_epoch = 0
         if load_best:
             with open(cls_output_file, 'r') as fin:
@@ -513,22 +670,18 @@ if __name__ == '__main__':
                     best_epoch = np.argmin(history['loss']) + 1
                     model_phase0.load_weights(checkpoint_path_phase0.format(epoch=best_epoch))
                 else:
-                    history = model_phase0.fit(
-                        training_inputs,
+                    history = fit(
+                        model_phase0,
                         training_outputs_phase0,
-                        validation_data=(val_inputs, val_outputs_phase0),
+                        val_outputs_phase0,
                         epochs=NUM_EPOCHS,
-                        batch_size=BATCH_SIZE,
                         callbacks=[cp_callback_phase0, es_callback],
                         initial_epoch=initial_epoch
                     )
                     with open(cls_output_file, 'a+') as fw:
                         fw.write("phase 0 training history {}:\n".format(datetime.now()))
                         fw.write(str(history.history) + '\n')
-                    evaluation_res = model.evaluate(x=test_inputs,
-                                                    y=test_outputs,
-                                                    batch_size=BATCH_SIZE,
-                                                    verbose=1)
+                    evaluation_res = evaluate_on_test(model)
                     with open(cls_output_file, 'a+') as fw:
                         fw.write("phase 0 evaluation {}:\n".format(datetime.now()))
                         fw.write(str(evaluation_res) + '\n')
@@ -552,42 +705,48 @@ if __name__ == '__main__':
                                                                         verbose=1,
                                                                         period=1)
                 if load_phase1:
-                    for ckpt_i in range(NUM_EPOCHS, 0, -1):
-                        if os.path.isfile(checkpoint_path_phase1.format(epoch=ckpt_i)):
-                            initial_epoch = ckpt_i
-                            model_phase1.load_weights(checkpoint_path_phase1.format(epoch=ckpt_i))
-                            # assert False  # dumm proof, most of the case the training is end-to-end, without disturbance and reloading
-                            break
+                    ckpt_i = latest_checkpoint_epoch(checkpoint_path_phase1, NUM_EPOCHS)
+                    if ckpt_i > 0:
+                        initial_epoch = ckpt_i
+                        model_phase1.load_weights(checkpoint_path_phase1.format(epoch=ckpt_i))
                     with open(cls_output_file, 'a+') as fw:
                         fw.write("phase 1 loaded, no training history {}:\n".format(datetime.now()))
+                elif cache_phase1_activations:
+                    # the head model shares its layers with model_phase1, which is saved as cp_callback_phase1 does
+                    save_callback_phase1 = model_checkpoint_callback(model_phase1, checkpoint_path_phase1)
+                    history = fit_head_on_cached_activations(
+                        phases[1],
+                        training_outputs_phase1,
+                        val_outputs_phase1,
+                        epochs=NUM_EPOCHS,
+                        initial_epoch=initial_epoch,
+                        callbacks=[save_callback_phase1, es_callback],
+                    )
+                    with open(cls_output_file, 'a+') as fw:
+                        fw.write("phase 1 training history {}:\n".format(datetime.now()))
+                        fw.write(str(history.history) + '\n')
                 else:
-                    history = model_phase1.fit(
-                        training_inputs,
+                    history = fit(
+                        model_phase1,
                         training_outputs_phase1,
-                        validation_data=(val_inputs, val_outputs_phase1),
+                        val_outputs_phase1,
                         epochs=NUM_EPOCHS,
                         initial_epoch=initial_epoch,
-                        batch_size=BATCH_SIZE,
                         callbacks=[cp_callback_phase1, es_callback],
                     )
                     with open(cls_output_file, 'a+') as fw:
                         fw.write("phase 1 training history {}:\n".format(datetime.now()))
                         fw.write(str(history.history) + '\n')
-                evaluation_res = model.evaluate(x=test_inputs,
-                                                y=test_outputs,
-                                                batch_size=BATCH_SIZE,
-                                                verbose=1)
+                evaluation_res = evaluate_on_test(model)
                 with open(cls_output_file, 'a+') as fw:
                     fw.write("phase 1 evaluation {}:\n".format(datetime.now()))
                     fw.write(str(evaluation_res) + '\n')
             else:
-                history = model.fit(
-                    training_inputs,
+                history = fit(
+                    model,
                     training_outputs,
-                    validation_data=(val_inputs,
-                                     val_outputs),
+                    val_outputs,
                     epochs=NUM_EPOCHS,
-                    batch_size=BATCH_SIZE,
                     callbacks=[cp_callback, es_callback],
                     initial_epoch=initial_epoch
                 )
@@ -596,11 +755,8 @@ if __name__ == '__main__':
                     fw.write(str(history.history) + '\n')
 
         if evaluate:
-            evaluation_res = model.evaluate(x=test_inputs,
-                                            y=test_outputs,
-                                            batch_size=BATCH_SIZE,
-                                            verbose=1)
-            pred = model.predict(x=test_inputs)
+            evaluation_res = evaluate_on_test(model)
+            pred = predict_model(model, test_inputs, LENGTH_BUCKETS)
             if exp_only:
                 eval_output_names = ['exp_loss', 'exp_f1',
                                      'exp_sp_precision', 'exp_sp_recall',
@@ -630,51 +786,56 @@ if __name__ == '__main__':
                 fw.write('\n')
 
         if exp_visualize:
-            test_inputs_head = [x[:len_head] for x in test_inputs]
-            pred = model_exp.predict(test_inputs_head)
-            pred = np.round(np.array(pred)).astype(np.int32)
             exp_vis_folder = os.path.join(output_dir, 'exp_outputs/')
             mkdirs(exp_vis_folder)
             print('marked rationals are saved under {}'.format(exp_vis_folder))
-            if not exp_only:
-                pred_cls = model_cls.predict(test_inputs_head)
-                #print(pred_cls[:10])
-                pred_cls = [label_list[int(round(x[0]))] for x in pred_cls]
-            for i, l in enumerate(tqdm(test)):
-                if i == len_head:
-                    break
-                label = label_list[test_labels[i][0]]
-                if not exp_only:
-                    pred_label = pred_cls[i]
-                    if label != pred_label:
-                        continue
-                input_ids = test_input_ids[i]
+            num_head = min(len_head, len(test))
+            # predicted and written chunk by chunk, only one chunk of (rnr) explainer outputs is in memory
+            for chunk_start in range(0, num_head, BENCHMARK_CHUNK_SIZE):
+                chunk = slice(chunk_start, min(chunk_start + BENCHMARK_CHUNK_SIZE, num_head))
+                test_inputs_chunk = [x[chunk] for x in test_inputs]
+                pred = predict_model(model_exp, test_inputs_chunk, LENGTH_BUCKETS)
+                pred = np.round(np.array(pred)).astype(np.int32)
                 if exp_structure == 'rnr':
-                    pred_intp = rnr_matrix_to_rational_mask(pred[i])[0]
-                elif exp_structure == 'gru':
-                    pred_intp = pred[i].reshape([-1])
-
-                #print(label)
-                gt = test_rations[i].reshape([-1])
-                html = convert_res_to_htmls(input_ids, pred_intp, gt, vocab)
-                if "fada5e" not in html[1]:
-                    continue
-                fname = l.annotation_id
-                if l.docids is not None:
-                    fname += '-' + l.docids[0]
-                with open(exp_vis_folder + fname + '.html', "w+") as f:
+                    pred = rnr_matrices_to_rational_masks(pred)
+                if not exp_only:
+                    pred_cls = predict_model(model_cls, test_inputs_chunk, LENGTH_BUCKETS)
+                    #print(pred_cls[:10])
+                    pred_cls = [label_list[int(round(x[0]))] for x in pred_cls]
+                for j, l in enumerate(tqdm(test[chunk])):
+                    i = chunk_start + j
+                    label = label_list[test_labels[i][0]]
                     if not exp_only:
-                        f.write(f'<h1>predict: {pred_label}</h1\n>')
-                    f.write(html[1])
-                    f.write('<br/><br/>\n')
+                        pred_label = pred_cls[j]
+                        if label != pred_label:
+                            continue
+                    input_ids = test_input_ids[i]
+                    if exp_structure == 'rnr':
+                        pred_intp = pred[j]
+                    elif exp_structure == 'gru':
+                        pred_intp = pred[j].reshape([-1])
+
                     #print(label)
-                    #print(label_list)
-                    f.write('<h1>label: {}</h1>\n'.format(label))
-                    f.write(html[0])
+                    gt = test_rations[i].reshape([-1])
+                    html = convert_res_to_htmls(input_ids, pred_intp, gt, vocab)
+                    if "fada5e" not in html[1]:
+                        continue
+                    fname = l.annotation_id
+                    if l.docids is not None:
+                        fname += '-' + l.docids[0]
+                    with open(exp_vis_folder + fname + '.html', "w+") as f:
+                        if not exp_only:
+                            f.write(f'<h1>predict: {pred_label}</h1\n>')
+                        f.write(html[1])
+                        f.write('<br/><br/>\n')
+                        #print(label)
+                        #print(label_list)
+                        f.write('<h1>label: {}</h1>\n'.format(label))
+                        f.write(html[0])
 
         if exp_benchmark or save_machine_rationale:
-            from eraser_benchmark import pred_to_results, get_cls_score, add_cls_scores, remove_rations, \
-                extract_rations, rnr_matrix_to_rational_mask, ann_to_exp_output, convert_res_to_csv
+            from eraser_benchmark import pred_to_results, get_cs_scores, add_cls_scores, get_aopc_scores, \
+                add_thresholded_scores, remove_rations, extract_rations, ann_to_exp_output, convert_res_to_csv
 
             from eraserbenchmark.eraser import evaluate
             result_fname = RES_FOR_BENCHMARK_FNAME + '.jsonl'
@@ -686,96 +847,126 @@ if __name__ == '__main__':
             elif BENCHMARK_SPLIT_NAME == 'train':
                 benchmark_inputs, raw_input, benchmark_input_ids, benchmark_outputs = training_inputs, train, train_input_ids, training_outputs
 
-            pred = model.predict(x=benchmark_inputs)
-            if eval_annotations:
-                cls_pred = pred if exp_structure == 'none' else pred[0]
-                exp_pred = benchmark_outputs['exp_output']
-            elif exp_only:
-                cls_pred = np.array([[0] for i in pred])
-                exp_pred = pred
-            elif cls_only:
-                cls_pred = pred
-                exp_pred = np.array([[0 for j in range(MAX_SEQ_LENGTH)] for i in pred])
-            else:
-                cls_pred = pred[0]
-                exp_pred = pred[1]
-
             from bert_with_ration_eraser import FullTokenizerWithRations
 
             full_tokenizer = FullTokenizerWithRations.create_tokenizer_from_hub_module(gpu_id)
-            results = [pred_to_results(raw_input[i], benchmark_input_ids[i],
-                                       (cls_pred[i], exp_pred[i]),
-                                       HARD_SELECTION_COUNT,
-                                       HARD_SELECTION_THRESHOLD,
-                                       vocab, docs, label_list, exp_structure)
-                       for i in range(len(cls_pred))]
-            bert_tokens = [res[1] for res in results]
-            bert_tokens = {annotation_id: tokens for annotation_id, tokens in bert_tokens}
-            results = [res[0] for res in results]
-
-            if save_machine_rationale:
-                ref = {ri.annotation_id: ri for ri in raw_input}
-                machine_rationale_folder = os.path.join(machine_rationale_folder, dataset)
-                if not os.path.isdir(machine_rationale_folder):
-                    os.mkdir(machine_rationale_folder)
-                if exp_only or BENCHMARK_SPLIT_NAME == 'test':
-                    exp_output_res = [ann_to_exp_output(ann, ref, reset_cls_prediction=True) for ann in results] # for two-stage model where the first stage has exp only. We don't care about the correctness of the cls prediction in the first stage
-                else:
-                    exp_output_res = [ann_to_exp_output(ann, ref) for ann in results]
-                exp_output_res = list(filter(lambda x: len(x) > 0, exp_output_res))
-                exp_output_fname = RES_FOR_BENCHMARK_FNAME + '_' \
-                                   + BENCHMARK_SPLIT_NAME + '_exp_output.jsonl'
-                exp_output_fname = os.path.join(machine_rationale_folder, exp_output_fname)
-                import json
-                with open(exp_output_fname, 'w+') as fout:
-                    for res in exp_output_res:
-                        if len(res) == 0:
-                            continue
-                        res['evidences'] = [res['evidences']]
-                        json.dump(res, fout)
-                        fout.write('\n')
-                # exp_output_docs_dir = os.path.join(exp_output_folder, 'docs')
-                exp_csv_fname = exp_output_fname[:-5] + 'csv'
-                exp_csv = convert_res_to_csv(results, benchmark_input_ids, bert_tokens, ref)
-                exp_csv.to_csv(exp_csv_fname)
-            elif exp_benchmark:
-
-                pred_softmax = np.hstack([1 - cls_pred, cls_pred])
-                if exp_only:
-                    c_pred_softmax = np.array([[0.5, 0.5] for i in pred])
-                    s_pred_softmax = np.array([[0.5, 0.5] for i in pred])
-                else:
-                    c_pred_softmax = get_cls_score(
-                        model, results, docs, label_list, dataset, remove_rations, MAX_SEQ_LENGTH, exp_structure,
-                        gpu_id=gpu_id, tokenizer=full_tokenizer)
-                    s_pred_softmax = get_cls_score(
-                        model, results, docs, label_list, dataset, extract_rations, MAX_SEQ_LENGTH, exp_structure,
-                        gpu_id=gpu_id, tokenizer=full_tokenizer)
-
-                #print(len(results), len(exp_pred))
-                #print(len(pred_softmax))
-                #print(len(c_pred_softmax))
-                #print(len(s_pred_softmax))
-
-                results = [add_cls_scores(res,
-                                          cls_score,
-                                          c_cls_score,
-                                          s_cls_score,
-                                          label_list) for res, cls_score, c_cls_score, s_cls_score in zip(results,
-                                                                                                          pred_softmax,
-                                                                                                          c_pred_softmax,
-                                                                                                          s_pred_softmax)]
-                anns_saved = set()
-                real_results = []
-                #print(len(results))
-                #print(results[0]['annotation_id'])
-                for ann in results:
-                    if ann['annotation_id'] not in anns_saved:
-                        anns_saved.add(ann['annotation_id'])
-                        real_results.append(ann)
-                print(len(real_results))
-                with open(result_fname + 'pkl3', "wb+") as pfout:
-                    pickle.dump(real_results, pfout)
+
+            # the output files are closed before the benchmark reads them back
+            from contextlib import ExitStack
+            with ExitStack() as outputs:
+                if save_machine_rationale:
+                    import json
+
+                    ref = {ri.annotation_id: ri for ri in raw_input}
+                    machine_rationale_folder = os.path.join(machine_rationale_folder, dataset)
+                    if not os.path.isdir(machine_rationale_folder):
+                        os.mkdir(machine_rationale_folder)
+                    exp_output_fname = RES_FOR_BENCHMARK_FNAME + '_' \
+                                       + BENCHMARK_SPLIT_NAME + '_exp_output.jsonl'
+                    exp_output_fname = os.path.join(machine_rationale_folder, exp_output_fname)
+                    # exp_output_docs_dir = os.path.join(exp_output_folder, 'docs')
+                    exp_csv_fname = exp_output_fname[:-5] + 'csv'
+                    fout = outputs.enter_context(open(exp_output_fname, 'w+'))
+                    num_csv_rows = 0
+                elif exp_benchmark:
+                    pfout = outputs.enter_context(open(result_fname + 'pkl3', "wb+"))
+                    anns_saved = set()
+
+                # predicted, decoded and written to disk chunk by chunk, so the memory does not grow with the split
+                for chunk_start in range(0, len(raw_input), BENCHMARK_CHUNK_SIZE):
+                    chunk = slice(chunk_start, chunk_start + BENCHMARK_CHUNK_SIZE)
+                    chunk_inputs = [x[chunk] for x in benchmark_inputs]
+                    chunk_input_ids = benchmark_input_ids[chunk]
+                    if exp_structure == 'rnr' and model.output_names[-1] == 'exp_output':
+                        # the rnr matrices are decoded batch by batch, pred holds (N, MAX_SEQ_LENGTH) masks
+                        pred = predict_rnr_rational_masks(model, chunk_inputs, batch_size=BATCH_SIZE)
+                    else:
+                        pred = predict_model(model, chunk_inputs, LENGTH_BUCKETS)
+                    if eval_annotations:
+                        cls_pred = pred if exp_structure == 'none' else pred[0]
+                        exp_pred = benchmark_outputs['exp_output'][chunk]
+                    elif exp_only:
+                        cls_pred = np.array([[0] for i in pred])
+                        exp_pred = pred
+                    elif cls_only:
+                        cls_pred = pred
+                        exp_pred = np.array([[0 for j in range(MAX_SEQ_LENGTH)] for i in pred])
+                    else:
+                        cls_pred = pred[0]
+                        exp_pred = pred[1]
+
+                    results = [pred_to_results(raw_input[chunk_start + i], chunk_input_ids[i],
+                                               (cls_pred[i], exp_pred[i]),
+                                               HARD_SELECTION_COUNT,
+                                               HARD_SELECTION_THRESHOLD,
+                                               vocab, docs, label_list, exp_structure, full_tokenizer)
+                               for i in range(len(cls_pred))]
+                    bert_tokens = [res[1] for res in results]
+                    bert_tokens = {annotation_id: tokens for annotation_id, tokens in bert_tokens}
+                    results = [res[0] for res in results]
+
+                    if save_machine_rationale:
+                        if exp_only or BENCHMARK_SPLIT_NAME == 'test':
+                            exp_output_res = [ann_to_exp_output(ann, ref, reset_cls_prediction=True) for ann in results] # for two-stage model where the first stage has exp only. We don't care about the correctness of the cls prediction in the first stage
+                        else:
+                            exp_output_res = [ann_to_exp_output(ann, ref) for ann in results]
+                        exp_output_res = list(filter(lambda x: len(x) > 0, exp_output_res))
+                        for res in exp_output_res:
+                            if len(res) == 0:
+                                continue
+                            res['evidences'] = [res['evidences']]
+                            json.dump(res, fout)
+                            fout.write('\n')
+                        exp_csv = convert_res_to_csv(results, chunk_input_ids, bert_tokens, ref)
+                        exp_csv.index += num_csv_rows
+                        exp_csv.to_csv(exp_csv_fname, mode='w' if num_csv_rows == 0 else 'a', header=num_csv_rows == 0)
+                        num_csv_rows += len(exp_csv)
+                    elif exp_benchmark:
+
+                        pred_softmax = np.hstack([1 - cls_pred, cls_pred])
+                        if exp_only:
+                            c_pred_softmax = np.array([[0.5, 0.5] for i in pred])
+                            s_pred_softmax = np.array([[0.5, 0.5] for i in pred])
+                        else:
+                            # the full input prediction is pred_softmax, the counterfactuals are scored in one pass
+                            c_pred_softmax, s_pred_softmax = get_cs_scores(
+                                model, results, docs, label_list, dataset, MAX_SEQ_LENGTH, exp_structure,
+                                tokenizer=full_tokenizer, bucket_lengths=LENGTH_BUCKETS)
+
+                        #print(len(results), len(exp_pred))
+                        #print(len(pred_softmax))
+                        #print(len(c_pred_softmax))
+                        #print(len(s_pred_softmax))
+
+                        results = [add_cls_scores(res,
+                                                  cls_score,
+                                                  c_cls_score,
+                                                  s_cls_score,
+                                                  label_list) for res, cls_score, c_cls_score, s_cls_score in zip(results,
+                                                                                                                  pred_softmax,
+                                                                                                                  c_pred_softmax,
+                                                                                                                  s_pred_softmax)]
+                        if AOPC_THRESHOLDS and not (exp_only or cls_only) \
+                                and 'soft_rationale_predictions' in results[0]['rationales'][0]:
+                            # every bin of every example is scored in one prediction stream
+                            c_aopc_softmax, s_aopc_softmax = get_aopc_scores(
+                                model, results, docs, label_list, dataset, MAX_SEQ_LENGTH, exp_structure,
+                                tokenizer=full_tokenizer, thresholds=AOPC_THRESHOLDS, bucket_lengths=LENGTH_BUCKETS)
+                            results = [add_thresholded_scores(res, AOPC_THRESHOLDS, c_aopc_softmax[:, i],
+                                                              s_aopc_softmax[:, i], label_list)
+                                       for i, res in enumerate(results)]
+                        real_results = []
+                        #print(len(results))
+                        #print(results[0]['annotation_id'])
+                        for ann in results:
+                            if ann['annotation_id'] not in anns_saved:
+                                anns_saved.add(ann['annotation_id'])
+                                real_results.append(ann)
+                        # one pickle per chunk, eraserbenchmark.eraser.evaluate reads them all
+                        pickle.dump(real_results, pfout)
+
+            if exp_benchmark and not save_machine_rationale:
+                print(len(anns_saved))
 
                 evaluate(model_name, dataset, BENCHMARK_SPLIT_NAME, train_on_portion, data_dir)
         with open(cls_output_file, 'a+') as fw:
@@ -8,24 +8,13 @@ import numpy as np
 from bert.run_classifier import InputExample
 from bert_with_ration import convert_examples_to_features, \
     FullTokenizerWithRations
+from bert_utils import get_tokenizer
 from config import *
 
 
 def create_tokenizer_from_hub_module():
-    """Get the vocab file and casing info from the Hub module."""
-    with tf.Graph().as_default():  # basically useless, but good practice to specify the graph using, even it sets the default graph as the default graph
-        bert_module = hub.Module(BERT_MODEL_HUB)
-        tokenization_info = bert_module(signature="tokenization_info", as_dict=True)
-        config = tf.ConfigProto()
-        config.gpu_options.allow_growth = True
-        config.gpu_options.visible_device_list = '0'
-        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
-        with tf.Session(
-                config=config) as sess:  # create a new session, with session we can setup even remote computation
-            vocab_file, do_lower_case = sess.run([tokenization_info["vocab_file"],
-                                                  tokenization_info["do_lower_case"]])
-
-    return FullTokenizerWithRations(vocab_file=vocab_file, do_lower_case=do_lower_case)
+    """The process-wide tokenizer; the vocab is resolved locally, without loading the Hub module graph."""
+    return get_tokenizer(FullTokenizerWithRations, gpu_id='0')
 
 
 def load_bert_features(data, label_list, max_seq_length, data_columns, label_column):
@@ -1,7 +1,11 @@
 # bert_data_preprocessing_rational_eraser.py
+import hashlib
+import json
+from dataclasses import asdict, replace
 from itertools import chain
 
 import numpy as np
+import os
 import tensorflow as tf
 
 if tf.__version__.startswith('2'):
@@ -10,30 +14,29 @@ import tensorflow_hub as hub
 from copy import deepcopy
 
 from bert_with_ration_eraser import convert_examples_to_features, \
+    DocumentTokenCache, \
     FullTokenizerWithRations, \
     InputRationalExample
+from bert_utils import get_tokenizer
 from config import *
+from eraserbenchmark.eraser_utils import extract_doc_ids_from_annotations
 from eraserbenchmark.rationale_benchmark.utils import Evidence
+from utils import dump_npy_shards, load_npy_manifest, load_npy_shards
+
+# part of the preprocessing cache key, bump it whenever a change here alters the features
+PREPROCESSING_VERSION = 2
 
 
 def create_tokenizer_from_hub_module(gpu_id):
-    """Get the vocab file and casing info from the Hub module."""
-    with tf.Graph().as_default():  # basically useless, but good practice to specify the graph using, even it sets the default graph as the default graph
-        bert_module = hub.Module(BERT_MODEL_HUB)
-        tokenization_info = bert_module(signature="tokenization_info", as_dict=True)
-        config = tf.ConfigProto()
-        config.gpu_options.allow_growth = True
-        config.gpu_options.visible_device_list = gpu_id
-        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
-        with tf.Session(
-                config=config) as sess:  # create a new session, with session we can setup even remote computation
-            vocab_file, do_lower_case = sess.run([tokenization_info["vocab_file"],
-                                                  tokenization_info["do_lower_case"]])
-    return FullTokenizerWithRations(vocab_file=vocab_file, do_lower_case=do_lower_case)
-
-
-def load_bert_features(data, docs, label_list, max_seq_length, merge_evidences, decorator, gpu_id):
+    """The process-wide tokenizer; the vocab is resolved locally, without loading the Hub module graph."""
+    return get_tokenizer(FullTokenizerWithRations, gpu_id=gpu_id)
+
+
+def load_bert_features(data, docs, label_list, max_seq_length, merge_evidences, decorator, gpu_id, num_workers=1):
     tokenizer = create_tokenizer_from_hub_module(gpu_id)
+    assert len(tokenizer.vocab) <= np.iinfo(np.uint16).max + 1  # input ids are stored as uint16
+    # documents are tokenized once and spliced into every example citing them, unless a decorator rewrites them
+    doc_cache = DocumentTokenCache(tokenizer, docs) if decorator is None else None
     input_examples = []
     for ann_id, ann in enumerate(data):
         text_a = ann.query
@@ -41,12 +44,18 @@ def load_bert_features(data, docs, label_list, max_seq_length, merge_evidences,
         if not merge_evidences:
             for ev_group in ann.evidences:
                 doc_ids = list(set([ev.docid for ev in ev_group]))
+                evidences = ev_group
+                if doc_cache is not None:
+                    input_examples.append(InputRationalExample(guid=None,
+                                                               text_a=text_a,
+                                                               label=label,
+                                                               evidences=evidences,
+                                                               tokens_b=doc_cache.tokenize(doc_ids, evidences)))
+                    continue
                 sentences = chain.from_iterable(docs[doc_id] for doc_id in doc_ids)
                 flattened_tokens = chain(*sentences)
                 text_b = ' '.join(flattened_tokens)
-                evidences = ev_group
-                if decorator is not None:
-                    text_b = decorator(text_b, evidences)
+                text_b = decorator(text_b, evidences)
                 input_examples.append(InputRationalExample(guid=None,
                                                            text_a=text_a,
                                                            text_b=text_b,
@@ -56,6 +65,7 @@ def load_bert_features(data, docs, label_list, max_seq_length, merge_evidences,
             docids_to_offsets = dict()
             latest_offset = 0
             example_evidences = []
+            example_docids = []
             text_b_tokens = []
 
             for ev_group in ann.evidences:
@@ -63,11 +73,12 @@ def load_bert_features(data, docs, label_list, max_seq_length, merge_evidences,
                     if ev.docid in docids_to_offsets:
                         offset = docids_to_offsets[ev.docid]
                     else:
-                        tokens = list(chain.from_iterable(docs[ev.docid]))
                         docids_to_offsets[ev.docid] = latest_offset
                         offset = latest_offset
-                        latest_offset += len(tokens)
-                        text_b_tokens += tokens
+                        latest_offset += sum(len(sentence) for sentence in docs[ev.docid])
+                        example_docids.append(ev.docid)
+                        if doc_cache is None:
+                            text_b_tokens += list(chain.from_iterable(docs[ev.docid]))
                     example_ev = Evidence(text=ev.text,
                                           docid=ev.docid,
                                           start_token=offset + ev.start_token,
@@ -78,8 +89,15 @@ def load_bert_features(data, docs, label_list, max_seq_length, merge_evidences,
             # if len(text_b_tokens) == 0:
             #     text_b_tokens = list(chain.from_iterable(
             #                             chain.from_iterable(docs[i] for i in ann.docids)))
-            text_b = ' '.join(text_b_tokens)
             evidences = example_evidences
+            if doc_cache is not None:
+                input_examples.append(InputRationalExample(guid=None,
+                                                           text_a=text_a,
+                                                           label=label,
+                                                           evidences=evidences,
+                                                           tokens_b=doc_cache.tokenize(example_docids, evidences)))
+                continue
+            text_b = ' '.join(text_b_tokens)
             if decorator is not None:
                 text_b = decorator(text_b, evidences, tokenizer)
             input_examples.append(InputRationalExample(guid=None,
@@ -94,52 +112,160 @@ def load_bert_features(data, docs, label_list, max_seq_length, merge_evidences,
             #    print(text_b)
             #    print("#"*100)
 
-    features = convert_examples_to_features(input_examples, label_list, max_seq_length, tokenizer)
+    features = convert_examples_to_features(input_examples, label_list, max_seq_length, tokenizer, num_workers)
     # print(data[10].annotation_id)
     # print(input_examples[10].text_b)
     # print(features[10].input_ids)
     return features
 
 
+def unpack_rations(packed_rations, exp_output='gru', max_seq_length=MAX_SEQ_LENGTH):
+    """Expands the bit-packed rationale masks of convert_bert_features into the (N, max_seq_length, 1)
+    uint8 targets of the explainer, or into (N, max_seq_length, 2) start/end targets for 'interval'."""
+    rations = np.unpackbits(packed_rations, axis=-1)[..., :max_seq_length]
+    rations = rations.reshape(rations.shape[:-1] + (max_seq_length, 1))
+    if exp_output == 'interval':
+        rations = rations.astype(np.int8)
+        rations = np.concatenate([np.zeros_like(rations[..., :1, :]),
+                                  rations,
+                                  np.zeros_like(rations[..., :1, :])], axis=-2)
+        rations = rations[..., 1:, :] - rations[..., :-1, :]
+        rations_start = (rations > 0)[..., :-1, :].astype(np.uint8)
+        rations_end = (rations < 0)[..., 1:, :].astype(np.uint8)
+        rations = np.concatenate((rations_start, rations_end), axis=-1)
+    return rations
+
+
 def convert_bert_features(features, with_label_id, with_rations, exp_output='gru'):
-    feature_names = "input_ids input_mask segment_ids".split()
-
-    input_ids, input_masks, segment_ids = \
-        list(map(lambda x: [getattr(f, x) for f in features], feature_names))
-
-    rets = [input_ids, input_masks, segment_ids]
-
-    if with_rations:
-        feature_names.append('rations')
-        rations = [getattr(f, 'rations') for f in features]
-        rations = np.array(rations).reshape([-1, MAX_SEQ_LENGTH, 1])
-        if exp_output == 'interval':
-            rations = np.concatenate([np.zeros((rations.shape[0], 1, 1)),
-                                      rations,
-                                      np.zeros((rations.shape[0], 1, 1))], axis=-2)
-            rations = rations[:, 1:, :] - rations[:, :-1, :]
-            rations_start = (rations > 0)[:, :-1, :].astype(np.int32)
-            rations_end = (rations < 0)[:, 1:, :].astype(np.int32)
-            rations = np.concatenate((rations_start, rations_end), axis=-1)
-        rets.append(rations)
-    else:
-        rets.append(None)
-
-    if with_label_id:
-        feature_names.append('label_id')
-        label_id = [getattr(f, 'label_id') for f in features]
-        labels = np.array(label_id).reshape(-1, 1)
-        rets.append(labels)
-    else:
-        rets.append(None)
-    return rets
+    """Writes the features into preallocated compact arrays: uint16 input ids, uint8 masks, segment ids and
+    labels, and rationale masks bit-packed along the sequence axis (see unpack_rations)."""
+    num_features = len(features)
+    input_ids = np.zeros((num_features, MAX_SEQ_LENGTH), dtype=np.uint16)
+    input_masks = np.zeros((num_features, MAX_SEQ_LENGTH), dtype=np.uint8)
+    segment_ids = np.zeros((num_features, MAX_SEQ_LENGTH), dtype=np.uint8)
+    rations = np.zeros((num_features, (MAX_SEQ_LENGTH + 7) // 8), dtype=np.uint8) if with_rations else None
+    labels = np.zeros((num_features, 1), dtype=np.uint8) if with_label_id else None
+
+    for i, f in enumerate(features):
+        input_ids[i] = f.input_ids
+        input_masks[i] = f.input_mask
+        segment_ids[i] = f.segment_ids
+        if with_rations:
+            rations[i] = np.packbits(np.asarray(f.rations, dtype=np.uint8))
+        if with_label_id:
+            labels[i] = f.label_id
+
+    return [input_ids, input_masks, segment_ids, rations, labels]
 
 
 def preprocess(data, docs, label_list, dataset_name, max_seq_length, exp_output, merge_evidences, data_decorator=None,
-               gpu_id='0'):
-    features = load_bert_features(data, docs, label_list, max_seq_length, merge_evidences, data_decorator, gpu_id)
+               gpu_id='0', num_workers=1):
+    features = load_bert_features(data, docs, label_list, max_seq_length, merge_evidences, data_decorator, gpu_id,
+                                  num_workers)
 
     with_rations = ('cls' not in dataset_name)
     with_lable_id = ('seq' not in dataset_name)
 
     return convert_bert_features(features, with_lable_id, with_rations, exp_output)
+
+
+FEATURE_FIELDS = ['input_ids', 'input_masks', 'segment_ids', 'rations', 'labels']
+
+
+def _evidence_group_json(ev_group):
+    return json.dumps([asdict(ev) for ev in ev_group], sort_keys=True)
+
+
+def _row_units(ann, merge_evidences):
+    """The evidence groups behind each feature row of ann, in the order load_bert_features produces the rows:
+    one row per group, or a single row of all groups with merge_evidences."""
+    if merge_evidences:
+        return [tuple(ann.evidences)]
+    return [(ev_group,) for ev_group in ann.evidences]
+
+
+def row_keys(data, docs, merge_evidences):
+    """Content hash of every feature row of data, in row order.
+
+    A key covers the query, the label, the evidence groups of the row and the documents they cite. The groups
+    of a merged row are hashed sorted, so no key depends on the iteration order of the ann.evidences frozenset,
+    which changes with the string hash seed of the process.
+    """
+    doc_hashes = dict()
+    keys = []
+    for ann in data:
+        for unit in _row_units(ann, merge_evidences):
+            evidences = sorted(_evidence_group_json(ev_group) for ev_group in unit)
+            hasher = hashlib.sha1(json.dumps([ann.query, ann.classification, evidences]).encode('utf8'))
+            for docid in sorted(extract_doc_ids_from_annotations([replace(ann, evidences=unit)])):
+                if docid not in doc_hashes:
+                    doc_hashes[docid] = hashlib.sha1(json.dumps(docs.get(docid)).encode('utf8')).hexdigest()
+                hasher.update(doc_hashes[docid].encode('utf8'))
+            keys.append(hasher.hexdigest())
+    return keys
+
+
+def preprocess_incremental(data, docs, label_list, dataset_name, max_seq_length, exp_output, merge_evidences,
+                           row_store_dir, data_decorator=None, gpu_id='0', num_workers=1):
+    """Same output as preprocess, but only the rows of new or changed evidence groups are tokenized.
+
+    Every feature row is kept in row_store_dir under its content hash (see row_keys). Stored rows are copied
+    from there, in the current order of the annotations and their evidence groups, the rest is tokenized from
+    the annotations cut down to their missing groups, and rows no longer in data are dropped from the store.
+    """
+    keys = row_keys(data, docs, merge_evidences)
+
+    old_rows, old_index = None, dict()
+    if os.path.isfile(os.path.join(row_store_dir, 'manifest.json')):
+        old_rows = load_npy_shards(row_store_dir)[0]
+        stored_keys = load_npy_manifest(row_store_dir)['extra']['keys']
+        if len(stored_keys) == len(old_rows[0]):  # one row per key, else a store of an older layout
+            old_index = {key: i for i, key in enumerate(stored_keys)}
+
+    # the annotations to tokenize, holding only their evidence groups without stored rows
+    missing_data, new_index = [], dict()
+    key_iter = iter(keys)
+    for ann in data:
+        missing_groups, missing = [], False
+        for unit in _row_units(ann, merge_evidences):
+            key = next(key_iter)
+            if key not in old_index and key not in new_index:
+                new_index[key] = len(new_index)
+                missing_groups += unit
+                missing = True
+        if missing:
+            missing_data.append(ann if merge_evidences else replace(ann, evidences=tuple(missing_groups)))
+    print('{} of {} rows to (re-)tokenize'.format(len(new_index), len(keys)))
+    new_rows = None
+    if len(missing_data) > 0:
+        new_rows = preprocess(missing_data, docs, label_list, dataset_name, max_seq_length,
+                              exp_output, merge_evidences, data_decorator, gpu_id, num_workers)
+    if new_rows is None and old_rows is None:  # an empty split, and nothing stored
+        return convert_bert_features([], ('seq' not in dataset_name), ('cls' not in dataset_name), exp_output)
+
+    # source of every output row: a row index into the stored rows or into the new rows
+    from_old = np.array([key in old_index for key in keys], dtype=bool)
+    old_rows_index = np.array([old_index[key] for key in keys if key in old_index], dtype=int)
+    new_rows_index = np.array([new_index[key] for key in keys if key not in old_index], dtype=int)
+
+    rets = []
+    for field_id in range(len(FEATURE_FIELDS)):
+        template = (new_rows if new_rows is not None else old_rows)[field_id]
+        if template is None:
+            rets.append(None)
+            continue
+        field = np.zeros((len(keys),) + template.shape[1:], dtype=template.dtype)
+        if len(old_rows_index) > 0:
+            field[from_old] = old_rows[field_id][old_rows_index]
+        if len(new_rows_index) > 0:
+            field[~from_old] = new_rows[field_id][new_rows_index]
+        rets.append(field)
+
+    # the store holds every distinct row once
+    first_rows = dict()
+    for row_id, key in enumerate(keys):
+        first_rows.setdefault(key, row_id)
+    stored = np.array(list(first_rows.values()), dtype=int)
+    dump_npy_shards([[None if field is None else field[stored] for field in rets]], row_store_dir, ['rows'],
+                    FEATURE_FIELDS, extra={'keys': list(first_rows)}, replace=True)
+    return rets
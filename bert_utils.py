@@ -1,3 +1,8 @@
+import hashlib
+import tempfile
+from functools import lru_cache
+
+import os
 import tensorflow
 
 if tensorflow.__version__.startswith('2'):
@@ -11,12 +16,93 @@ from bert.tokenization import load_vocab
 from config import *
 
 
-def get_vocab(config):
+def _hub_cache_vocab_file(bert_model_hub):
+    # TF-Hub keeps a downloaded module under <cache dir>/<sha1 of its url>, the vocab is one of its assets
+    cache_dir = os.environ.get('TFHUB_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'tfhub_modules'))
+    module_dir = os.path.join(cache_dir, hashlib.sha1(bert_model_hub.encode('utf8')).hexdigest())
+    return os.path.join(module_dir, 'assets', 'vocab.txt')
+
+
+def gpu_session_config(gpu_id=None):
+    """The session config the Hub module is run with: only gpu_id visible, and GPU memory allocated on demand."""
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    if gpu_id is not None:
+        config.gpu_options.visible_device_list = gpu_id
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
+def _vocab_from_hub_module(bert_model_hub, session_config):
+    """Get the vocab file and casing info from the Hub module."""
     with tf.Graph().as_default():
-        bert_module = hub.Module(BERT_MODEL_HUB)
-        tokenization_info = bert_module(signature="tokenization_info",
-                                        as_dict=True)
-        with tf.Session(config=config) as sess:
-            vocab_file = sess.run(tokenization_info["vocab_file"])
-    vocab = load_vocab(vocab_file)
-    return vocab
+        bert_module = hub.Module(bert_model_hub)
+        tokenization_info = bert_module(signature="tokenization_info", as_dict=True)
+        with tf.Session(config=session_config) as sess:
+            vocab_file, do_lower_case = sess.run([tokenization_info["vocab_file"],
+                                                  tokenization_info["do_lower_case"]])
+    if isinstance(vocab_file, bytes):
+        vocab_file = vocab_file.decode('utf8')
+    return vocab_file, bool(do_lower_case)
+
+
+_resolved_vocabs = dict()
+
+
+def resolve_vocab(vocab_file=None, bert_model_hub=BERT_MODEL_HUB, session_config=None, gpu_id=None):
+    """Returns (vocab_file, do_lower_case) without building the BERT graph or touching the network.
+
+    The vocab is taken, in this order, from the vocab_file argument, the BERT_VOCAB_FILE environment
+    variable or config entry, or the TF-Hub module cache. If none of them exists a ValueError is raised,
+    unless the Hub fallback is enabled (BERT_VOCAB_FROM_HUB, as environment variable or config entry): then
+    the Hub module, which may have to be downloaded, is instantiated once in a session with session_config,
+    or with gpu_session_config(gpu_id) if not given. The result is memoized per process.
+    """
+    key = (vocab_file, bert_model_hub)
+    if key not in _resolved_vocabs:
+        _resolved_vocabs[key] = _resolve_vocab(vocab_file, bert_model_hub, session_config, gpu_id)
+    return _resolved_vocabs[key]
+
+
+def _vocab_from_hub_enabled():
+    from_env = os.environ.get('BERT_VOCAB_FROM_HUB')
+    if from_env is not None:
+        return from_env.lower() not in ('', '0', 'false', 'no')
+    return BERT_VOCAB_FROM_HUB
+
+
+def _resolve_vocab(vocab_file, bert_model_hub, session_config, gpu_id):
+    vocab_file = vocab_file or os.environ.get('BERT_VOCAB_FILE') or BERT_VOCAB_FILE
+    if vocab_file is None and os.path.isfile(_hub_cache_vocab_file(bert_model_hub)):
+        vocab_file = _hub_cache_vocab_file(bert_model_hub)
+    if vocab_file is None:
+        if not _vocab_from_hub_enabled():
+            raise ValueError('No local BERT vocab for {}: pass --vocab_file or set BERT_VOCAB_FILE to its vocab.txt, '
+                             'or set BERT_VOCAB_FROM_HUB=1 to read it from the Hub module, which may download it'
+                             .format(bert_model_hub))
+        return _vocab_from_hub_module(bert_model_hub, session_config or gpu_session_config(gpu_id))
+    if BERT_DO_LOWER_CASE is not None:
+        return vocab_file, BERT_DO_LOWER_CASE
+    return vocab_file, 'uncased' in bert_model_hub
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(tokenizer_cls=None, vocab_file=None, gpu_id=None):
+    """One tokenizer per class and process, FullTokenizerWithRations of the eraser pipeline by default. gpu_id
+    is the GPU the Hub module may use if the vocab has to be read from it (see resolve_vocab)."""
+    if tokenizer_cls is None:
+        from bert_with_ration_eraser import FullTokenizerWithRations
+        tokenizer_cls = FullTokenizerWithRations
+    vocab_file, do_lower_case = resolve_vocab(vocab_file, gpu_id=gpu_id)
+    return tokenizer_cls(vocab_file=vocab_file, do_lower_case=do_lower_case)
+
+
+@lru_cache(maxsize=None)
+def _load_vocab(vocab_file):
+    return load_vocab(vocab_file)
+
+
+def get_vocab(config=None, vocab_file=None):
+    """The BERT vocab; config is the session config used if the vocab has to be read from the Hub module."""
+    vocab_file, _ = resolve_vocab(vocab_file, session_config=config)
+    return _load_vocab(vocab_file)
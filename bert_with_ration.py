@@ -75,20 +75,10 @@ class FullTokenizerWithRations(FullTokenizer):  # Test passed :)
         return list(zip(split_tokens, split_rations))
 
     @classmethod
-    def create_tokenizer_from_hub_module(self, gpu_id):
-        """Get the vocab file and casing info from the Hub module."""
-        with tf.Graph().as_default():  # basically useless, but good practice to specify the graph using, even it sets the default graph as the default graph
-            bert_module = hub.Module(BERT_MODEL_HUB)
-            tokenization_info = bert_module(signature="tokenization_info", as_dict=True)
-            config = tf.ConfigProto()
-            config.gpu_options.allow_growth = True
-            config.gpu_options.visible_device_list = gpu_id
-            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
-            with tf.Session(
-                    config=config) as sess:  # create a new session, with session we can setup even remote computation
-                vocab_file, do_lower_case = sess.run([tokenization_info["vocab_file"],
-                                                      tokenization_info["do_lower_case"]])
-        return FullTokenizerWithRations(vocab_file=vocab_file, do_lower_case=do_lower_case)
+    def create_tokenizer_from_hub_module(cls, gpu_id):
+        """The process-wide tokenizer; the vocab is resolved locally, without loading the Hub module graph."""
+        from bert_utils import get_tokenizer
+        return get_tokenizer(cls, gpu_id=gpu_id)
 # --------------------------------------------------------------------------------------
 
 class InputRationalFeatures(InputFeatures):
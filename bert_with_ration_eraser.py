@@ -2,6 +2,10 @@
 IRRATIONAL = 0
 RATIONAL = 1
 
+import multiprocessing
+import time
+from itertools import chain
+
 import tensorflow as tf
 if tf.__version__.startswith('2'):
     import tensorflow.compat.v1 as tf
@@ -15,42 +19,61 @@ from config import *
 
 
 class InputRationalExample(object):
-    def __init__(self, guid, text_a, text_b=None, label=None, evidences=None):
+    def __init__(self, guid, text_a, text_b=None, label=None, evidences=None, tokens_b=None):
         self.guid = guid
         self.text_a = text_a
         self.text_b = text_b
         self.label = label
         self.evidences = evidences
+        self.tokens_b = tokens_b  # (wordpiece, ration) pairs of text_b when it is already tokenized
 
 
 class BasicTokenizerWithRation(BasicTokenizer):  # usability test passed :)
     def __init__(self, do_lower_case=True):
         super(BasicTokenizerWithRation, self).__init__(do_lower_case)
 
-    def _is_token_rational(self, token_idx, evidences):
+    @staticmethod
+    def rational_bitmap(num_tokens, evidences):
+        """Per-token rationale bits, RATIONAL for the tokens covered by any evidence span.
+
+        Built with one sweep over a difference array, instead of testing every token against every evidence.
+        """
         if evidences is None:
-            return 0
+            return [IRRATIONAL] * num_tokens
+        boundaries = [0] * (num_tokens + 1)
         for ev in evidences:
-            if token_idx >= ev.start_token and token_idx < ev.end_token:
-                return 1
-        return 0
-
-    def tokenize(self, text, evidences):
+            start, end = max(ev.start_token, 0), min(ev.end_token, num_tokens)
+            if start < end:
+                boundaries[start] += 1
+                boundaries[end] -= 1
+        bitmap = []
+        covering = 0
+        for token_idx in range(num_tokens):
+            covering += boundaries[token_idx]
+            bitmap.append(RATIONAL if covering > 0 else IRRATIONAL)
+        return bitmap
+
+    def tokenize_words(self, text):
+        """The sub-tokens of every whitespace token of text, possibly empty, indexed like the evidence offsets."""
         text = convert_to_unicode(text)
         text = self._clean_text(text)
-        orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
-        split_rations = []
-        for token_idx, token in enumerate(orig_tokens):
+        words = []
+        for token in whitespace_tokenize(text):
             if self.do_lower_case:
                 token = token.lower()
                 token = self._run_strip_accents(token)
             sub_tokens = self._run_split_on_punc(token)
-            sub_tokens = ' '.join(sub_tokens).strip().split()
-            if len(sub_tokens) > 0:
-                split_tokens.extend(sub_tokens)
-                ration = self._is_token_rational(token_idx, evidences)
-                split_rations.extend([ration] * len(sub_tokens))
+            words.append(' '.join(sub_tokens).strip().split())
+        return words
+
+    def tokenize(self, text, evidences):
+        words = self.tokenize_words(text)
+        bitmap = self.rational_bitmap(len(words), evidences)
+        split_tokens = []
+        split_rations = []
+        for token_idx, sub_tokens in enumerate(words):
+            split_tokens.extend(sub_tokens)
+            split_rations.extend([bitmap[token_idx]] * len(sub_tokens))
         return zip(split_tokens, split_rations)
 
 
@@ -71,21 +94,42 @@ class FullTokenizerWithRations(FullTokenizer):  # Test passed :)
                 split_rations.append(ration)
         return list(zip(split_tokens, split_rations))
 
+    def tokenize_words(self, text):
+        return [[piece for sub_token in sub_tokens for piece in self.wordpiece_tokenizer.tokenize(sub_token)]
+                for sub_tokens in self.basic_rational_tokenizer.tokenize_words(text)]
+
     @classmethod
-    def create_tokenizer_from_hub_module(self, gpu_id):
-        """Get the vocab file and casing info from the Hub module."""
-        with tf.Graph().as_default():  # basically useless, but good practice to specify the graph using, even it sets the default graph as the default graph
-            bert_module = hub.Module(BERT_MODEL_HUB)
-            tokenization_info = bert_module(signature="tokenization_info", as_dict=True)
-            config = tf.ConfigProto()
-            config.gpu_options.allow_growth = True
-            config.gpu_options.visible_device_list = gpu_id
-            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
-            with tf.Session(
-                    config=config) as sess:  # create a new session, with session we can setup even remote computation
-                vocab_file, do_lower_case = sess.run([tokenization_info["vocab_file"],
-                                                      tokenization_info["do_lower_case"]])
-        return FullTokenizerWithRations(vocab_file=vocab_file, do_lower_case=do_lower_case)
+    def create_tokenizer_from_hub_module(cls, gpu_id):
+        """The process-wide tokenizer; the vocab is resolved locally, without loading the Hub module graph."""
+        from bert_utils import get_tokenizer
+        return get_tokenizer(cls, gpu_id=gpu_id)
+
+
+# --------------------------------------------------------------------------------------
+
+class DocumentTokenCache(object):
+    """Wordpieces of every document, tokenized once per docid and shared by all the annotations citing it.
+
+    Tokenization is independent across whitespace tokens, so splicing the cached words of several
+    documents gives the same wordpieces as tokenizing their joined text, and the evidence offsets
+    index the concatenated word lists directly.
+    """
+
+    def __init__(self, tokenizer, docs):
+        self.tokenizer = tokenizer
+        self.docs = docs
+        self._words = dict()
+
+    def words(self, docid):
+        if docid not in self._words:
+            self._words[docid] = self.tokenizer.tokenize_words(' '.join(chain.from_iterable(self.docs[docid])))
+        return self._words[docid]
+
+    def tokenize(self, docids, evidences=None):
+        """Same output as tokenizer.tokenize(' '.join(<tokens of docids>), evidences)."""
+        words = list(chain.from_iterable(self.words(docid) for docid in docids))
+        bitmap = BasicTokenizerWithRation.rational_bitmap(len(words), evidences)
+        return [(piece, bitmap[token_idx]) for token_idx, pieces in enumerate(words) for piece in pieces]
 
 
 # --------------------------------------------------------------------------------------
@@ -118,7 +162,9 @@ def convert_single_rational_example(ex_index, example, label_list, max_seq_lengt
 
     tokens_a = tokenizer.tokenize(example.text_a)
     tokens_b = None
-    if example.text_b:
+    if example.tokens_b is not None:
+        tokens_b = list(example.tokens_b)
+    elif example.text_b:
         tokens_b = tokenizer.tokenize(example.text_b, example.evidences)
 
     if tokens_b:
@@ -188,14 +234,46 @@ def convert_single_rational_example(ex_index, example, label_list, max_seq_lengt
     return feature
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer):
-    features = []
-    for (ex_index, example) in enumerate(tqdm(examples, desc="Converting examples to features")):
-        if ex_index % 10000 == 0:
-            tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
-        feature = convert_single_rational_example(ex_index, example, label_list,
-                                                  max_seq_length, tokenizer)
-        features.append(feature)
+_worker_args = None
+
+
+def _init_feature_worker(label_list, max_seq_length, tokenizer):
+    # every worker process keeps its own copy of the tokenizer
+    global _worker_args
+    _worker_args = (label_list, max_seq_length, tokenizer)
+
+
+def _convert_example_chunk(chunk):
+    start, examples = chunk
+    label_list, max_seq_length, tokenizer = _worker_args
+    return [convert_single_rational_example(start + i, example, label_list, max_seq_length, tokenizer)
+            for i, example in enumerate(examples)]
+
+
+def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, num_workers=1, chunk_size=256):
+    start_time = time.time()
+    if num_workers > 1:
+        examples = list(examples)
+        chunks = [(start, examples[start: start + chunk_size]) for start in range(0, len(examples), chunk_size)]
+        features = []
+        # spawn rather than fork, the caller may already hold a tf.Session
+        with multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_feature_worker,
+                                                       initargs=(label_list, max_seq_length, tokenizer)) as pool:
+            with tqdm(total=len(examples), desc="Converting examples to features") as pbar:
+                for chunk_features in pool.imap(_convert_example_chunk, chunks):  # imap keeps the input order
+                    features.extend(chunk_features)
+                    pbar.update(len(chunk_features))
+    else:
+        features = []
+        for (ex_index, example) in enumerate(tqdm(examples, desc="Converting examples to features")):
+            if ex_index % 10000 == 0:
+                tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+            feature = convert_single_rational_example(ex_index, example, label_list,
+                                                      max_seq_length, tokenizer)
+            features.append(feature)
+    elapsed = time.time() - start_time
+    print('converted {} examples in {:.1f}s ({:.1f} examples/s, {} worker(s))'.format(
+        len(features), elapsed, len(features) / max(elapsed, 1e-6), num_workers))
     return features
 
 
@@ -0,0 +1,128 @@
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+tf.disable_v2_behavior()
+
+
+def parse_bucket_lengths(spec, max_seq_length):
+    """'128,256,384' -> [128, 256, 384, max_seq_length]; the longest bucket always fits every example."""
+    if spec is None:
+        return None
+    bucket_lengths = sorted(set(int(length) for length in spec.split(',') if int(length) < max_seq_length))
+    return bucket_lengths + [max_seq_length]
+
+
+def bucket_of(input_masks, bucket_lengths):
+    """Index of the shortest bucket holding every example, by its number of non-padding tokens."""
+    lengths = np.asarray(input_masks).sum(axis=1)
+    return np.searchsorted(bucket_lengths, lengths)
+
+
+def make_batches(buckets, bucket_lengths, batch_size, shuffle=False, random_state=None):
+    """(bucket length, sorted example indices) per batch; shuffled within the buckets and in batch order."""
+    batches = []
+    for bucket_id, length in enumerate(bucket_lengths):
+        index = np.flatnonzero(buckets == bucket_id)
+        if shuffle:
+            random_state.shuffle(index)
+        for start in range(0, len(index), batch_size):
+            # sorted, so that the rows are read from the memory-mapped features in order
+            batches.append((length, np.sort(index[start: start + batch_size])))
+    if shuffle:
+        random_state.shuffle(batches)
+    return batches
+
+
+def _slice_outputs(outputs, index, length):
+    if isinstance(outputs, dict):
+        return {name: _slice_outputs(output, index, length) for name, output in outputs.items()}
+    outputs = np.asarray(outputs[index])
+    if outputs.ndim >= 3:  # token level targets, (N, MAX_SEQ_LENGTH, k)
+        outputs = outputs[:, :length]
+    return outputs
+
+
+def length_normalized_loss(loss_fn, max_seq_length):
+    """Keras averages a token level loss over the positions of the batch, so on truncated batches the short
+    examples would weigh more than in the padded setting. Rescaling by length / max_seq_length restores the
+    average over max_seq_length positions (padding positions add no loss there, their predictions are masked).
+    """
+    def loss(y_true, y_pred):
+        scale = tf.cast(tf.shape(y_true)[1], tf.float32) / max_seq_length
+        return loss_fn(y_true, y_pred) * scale
+
+    return loss
+
+
+class BucketedSequence(tf.keras.utils.Sequence):
+    """Batches of examples of similar length, cut to the length of their bucket instead of MAX_SEQ_LENGTH.
+
+    inputs are [input_ids, input_masks, segment_ids], outputs an array or a dict of arrays (or None for
+    prediction). The inputs are padded at the end, so cutting a batch at its bucket length only removes
+    padding: BERT masks it out of the attention, and the explainer outputs of the remaining positions
+    stay the same.
+    """
+
+    def __init__(self, inputs, outputs, bucket_lengths, batch_size, shuffle=False, seed=None):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.bucket_lengths = bucket_lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buckets = bucket_of(inputs[1], bucket_lengths)
+        self.random_state = np.random.RandomState(seed)
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        return make_batches(self.buckets, self.bucket_lengths, self.batch_size, self.shuffle, self.random_state)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, i):
+        length, index = self.batches[i]
+        x = [np.asarray(x[index])[:, :length] for x in self.inputs]
+        if self.outputs is None:
+            return x
+        return x, _slice_outputs(self.outputs, index, length)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.batches = self._make_batches()
+
+
+def fit_model(model, inputs, outputs, validation_data, bucket_lengths, batch_size, **kwargs):
+    if bucket_lengths is None:
+        return model.fit(inputs, outputs, validation_data=validation_data, batch_size=batch_size, **kwargs)
+    val_inputs, val_outputs = validation_data
+    return model.fit(BucketedSequence(inputs, outputs, bucket_lengths, batch_size, shuffle=True),
+                     validation_data=BucketedSequence(val_inputs, val_outputs, bucket_lengths, batch_size),
+                     **kwargs)
+
+
+def evaluate_model(model, inputs, outputs, bucket_lengths, batch_size, **kwargs):
+    if bucket_lengths is None:
+        return model.evaluate(x=inputs, y=outputs, batch_size=batch_size, **kwargs)
+    return model.evaluate(BucketedSequence(inputs, outputs, bucket_lengths, batch_size), **kwargs)
+
+
+def predict_model(model, inputs, bucket_lengths, batch_size=None, max_seq_length=512):
+    """model.predict, bucketed if bucket_lengths is given. Token level predictions of the bucketed batches are
+    zero-padded back to max_seq_length and everything is returned in input order, as model.predict does."""
+    if bucket_lengths is None:
+        return model.predict(inputs, batch_size=batch_size)
+    sequence = BucketedSequence(inputs, None, bucket_lengths, batch_size or 32)
+    num_examples = len(inputs[0])
+    preds = None
+    for i, (_, index) in enumerate(sequence.batches):
+        batch_preds = model.predict_on_batch(sequence[i])
+        if not isinstance(batch_preds, list):
+            batch_preds = [batch_preds]
+        if preds is None:
+            preds = [np.zeros((num_examples, max_seq_length) + p.shape[2:] if p.ndim >= 3 else
+                              (num_examples,) + p.shape[1:], dtype=p.dtype) for p in batch_preds]
+        for pred, batch_pred in zip(preds, batch_preds):
+            pred[index, :batch_pred.shape[1]] = batch_pred
+    if preds is None:
+        return model.predict(inputs, batch_size=batch_size)
+    return preds if len(preds) > 1 else preds[0]
@@ -0,0 +1,107 @@
+import argparse
+import json
+import pickle
+from collections import defaultdict
+
+from eraserbenchmark.eraser_utils import extract_doc_ids_from_annotations
+from eraserbenchmark.rationale_benchmark.utils import load_datasets, load_documents
+from subsequence_mining import tokenize_claim
+
+
+def evidence_text(ev, docs=None):
+    # the evidence sentences as stored in the Wikipedia document, ev.text when the document is unavailable
+    if docs is None or ev.docid not in docs or ev.start_sentence < 0:
+        return ev.text
+    sentences = docs[ev.docid][ev.start_sentence: max(ev.end_sentence, ev.start_sentence + 1)]
+    return ' '.join(' '.join(s) for s in sentences)
+
+
+class ClaimIndex(object):
+    """Inverted index from claim tokens to the positions they take in every annotation's query.
+
+    The evidence texts are joined with their documents once, when the index is built, so that a
+    pattern query only has to intersect a few posting lists and check the token positions.
+    """
+
+    def __init__(self, annotations, docs=None):
+        self.annotation_ids = []
+        self.queries = []
+        self.evidences = []
+        self.postings = defaultdict(dict)
+        for ann_idx, ann in enumerate(annotations):
+            self.annotation_ids.append(ann.annotation_id)
+            self.queries.append(ann.query)
+            self.evidences.append([evidence_text(ev, docs) for ev in ann.all_evidences()])
+            for pos, token in enumerate(tokenize_claim(ann.query)):
+                self.postings[token].setdefault(ann_idx, []).append(pos)
+        self.postings = dict(self.postings)
+
+    @classmethod
+    def from_data_dir(cls, data_dir, split='train'):
+        train, val, test = load_datasets(data_dir)
+        annotations = {'train': train, 'val': val, 'test': test}[split]
+        docs = load_documents(data_dir, extract_doc_ids_from_annotations(annotations))
+        return cls(annotations, docs)
+
+    def save(self, fname):
+        with open(fname, 'wb') as fout:
+            pickle.dump(self, fout)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, 'rb') as fin:
+            return pickle.load(fin)
+
+    def _matches(self, ann_idx, tokens, max_gap):
+        ends = self.postings[tokens[0]][ann_idx]
+        for token in tokens[1:]:
+            ends = [q for q in self.postings[token][ann_idx]
+                    if any(p < q <= p + max_gap + 1 for p in ends)]
+            if len(ends) == 0:
+                return False
+        return True
+
+    def search(self, pattern, max_gap=0):
+        """Returns the indices of the annotations whose query contains pattern, at most max_gap tokens
+        between consecutive pattern tokens (max_gap=0 for contiguous n-grams)."""
+        tokens = tokenize_claim(pattern) if isinstance(pattern, str) else list(pattern)
+        if len(tokens) == 0 or any(t not in self.postings for t in tokens):
+            return []
+        by_rarity = sorted(set(tokens), key=lambda t: len(self.postings[t]))
+        candidates = set(self.postings[by_rarity[0]].keys())
+        for token in by_rarity[1:]:
+            candidates &= self.postings[token].keys()
+        return sorted(i for i in candidates if self._matches(i, tokens, max_gap))
+
+    def subset(self, pattern, max_gap=0):
+        """The pattern subset as {query, evidences} rows, one per evidence, like the '<pattern>.json' files."""
+        rows = []
+        for ann_idx in self.search(pattern, max_gap):
+            for text in self.evidences[ann_idx]:
+                rows.append({'query': self.queries[ann_idx], 'evidences': text})
+        return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str)
+    parser.add_argument('--split', type=str, default='train', choices='train val test'.split())
+    parser.add_argument('--index_file', type=str, default='fever_claim_index.pkl')
+    parser.add_argument('--build', action='store_true')
+    parser.add_argument('--pattern', type=str, default=None)
+    parser.add_argument('--max_gap', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.build:
+        index = ClaimIndex.from_data_dir(args.data_dir, args.split)
+        index.save(args.index_file)
+    else:
+        index = ClaimIndex.load(args.index_file)
+    if args.pattern is not None:
+        rows = index.subset(args.pattern, args.max_gap)
+        print('{} claims, {} rows for "{}"'.format(len(index.search(args.pattern, args.max_gap)),
+                                                   len(rows), args.pattern))
+        if args.output is not None:
+            with open(args.output, 'w') as fout:
+                json.dump(rows, fout, indent=2, ensure_ascii=False)
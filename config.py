@@ -1,3 +1,6 @@
 BERT_MODEL_HUB = "https://tfhub.dev/google/bert_uncased_L-12_H-768_A-12/1"
 #BERT_MODEL_HUB = "https://216.58.212.174/google/bert_uncased_L-12_H-768_A-12/1"
 MAX_SEQ_LENGTH = 512
+BERT_VOCAB_FILE = None  # a local vocab.txt, see bert_utils.resolve_vocab
+BERT_VOCAB_FROM_HUB = False  # read the vocab from the (possibly downloaded) Hub module if there is no local one
+BERT_DO_LOWER_CASE = None  # inferred from BERT_MODEL_HUB when None
@@ -2,10 +2,9 @@ from itertools import chain
 
 import numpy as np
 import re
-from copy import deepcopy
 
 from bert_data_preprocessing_rational_eraser import convert_bert_features, create_tokenizer_from_hub_module
-from bert_with_ration_eraser import InputRationalExample, convert_examples_to_features
+from bert_with_ration_eraser import InputRationalExample, convert_examples_to_features, IRRATIONAL
 from eraserbenchmark.eraser_utils import extract_doc_ids_from_annotations
 from utils import convert_subtoken_ids_to_tokens
 from bert_with_ration_eraser import convert_ids_to_token_list
@@ -111,6 +110,148 @@ def get_cls_score(model, rationales, docs, label_list, dataset, decorate, max_se
     return (np.hstack([1 - _pred[0], _pred[0]]))
 
 
+def counterfactual_pieces(words_pieces, rationales, sub_pieces):
+    """Wordpieces of the remove_rations and extract_rations versions of one document at once.
+
+    words_pieces holds the wordpieces of every (lowercased, whitespace split) word of the document. Wordpieces
+    do not cross words, so the sub-token count of a span, which the decorators tokenize the span again for, is
+    the sum of the counts of its words, and both counterfactuals can be spliced from the pieces directly.
+    """
+    rationales = flatten_rations(rationales, len(words_pieces))
+    counts = [len(pieces) for pieces in words_pieces]
+    comprehensiveness, sufficiency = [], []
+    for rat_id, rat in enumerate(rationales[:-1]):
+        next_start = rationales[rat_id + 1]['start_token']
+        comprehensiveness += sub_pieces * sum(counts[rat['start_token']: rat['end_token']])
+        comprehensiveness += chain.from_iterable(words_pieces[rat['end_token']: next_start])
+        sufficiency += chain.from_iterable(words_pieces[rat['start_token']: rat['end_token']])
+        sufficiency += sub_pieces * sum(counts[rat['end_token']: next_start])
+    return comprehensiveness, sufficiency
+
+
+class _DocPieces:
+    """Wordpieces of every word of the documents of a rationale, tokenizing each document and distinct word once."""
+
+    def __init__(self, docs, tokenizer):
+        self.docs = docs
+        self.tokenizer = tokenizer
+        self.memo = dict()
+        self.doc_pieces = dict()
+
+    def word(self, word):
+        if word not in self.memo:
+            self.memo[word] = [piece for pieces in self.tokenizer.tokenize_words(word) for piece in pieces]
+        return self.memo[word]
+
+    def __call__(self, rational):
+        docids = tuple(rational['docids'])
+        if docids not in self.doc_pieces:
+            words = ' '.join(chain.from_iterable(chain.from_iterable(self.docs[docid] for docid in docids)))
+            self.doc_pieces[docids] = [self.word(word) for word in words.lower().split()]
+        return self.doc_pieces[docids]
+
+
+def _counterfactual_example(rational, pieces):
+    return InputRationalExample(guid=None,
+                                text_a=rational['query'],
+                                label=rational['classification'],
+                                tokens_b=[(piece, IRRATIONAL) for piece in pieces])
+
+
+def ce_load_fused_bert_features(rationales, docs, label_list, max_seq_length, tokenizer, sub='.'):
+    """Features of the comprehensiveness inputs of all rationales followed by their sufficiency inputs, the same
+    as ce_load_bert_features with remove_rations and with extract_rations, but every document and distinct word
+    is tokenized only once."""
+    doc_pieces = _DocPieces(docs, tokenizer)
+    sub_pieces = doc_pieces.word(sub)
+    comprehensiveness_examples, sufficiency_examples = [], []
+    for rational in rationales:
+        comprehensiveness, sufficiency = counterfactual_pieces(
+            doc_pieces(rational), rational['rationales'][0]['hard_rationale_predictions'], sub_pieces)
+        comprehensiveness_examples.append(_counterfactual_example(rational, comprehensiveness))
+        sufficiency_examples.append(_counterfactual_example(rational, sufficiency))
+    return convert_examples_to_features(comprehensiveness_examples + sufficiency_examples,
+                                        label_list, max_seq_length, tokenizer)
+
+
+def _predict_positive(model, features, dataset, max_seq_length, exp_output, bucket_lengths):
+    from bucketing import predict_model
+
+    with_rations = ('cls' not in dataset)
+    with_lable_id = ('seq' not in dataset)
+    _input_ids, _input_masks, _segment_ids, _, _ = convert_bert_features(features, with_lable_id, with_rations,
+                                                                         exp_output)
+    _pred = predict_model(model, [_input_ids, _input_masks, _segment_ids], bucket_lengths,
+                          max_seq_length=max_seq_length)
+    if not isinstance(_pred, list):
+        _pred = [_pred, ]
+    return np.hstack([1 - _pred[0], _pred[0]])
+
+
+def get_cs_scores(model, rationales, docs, label_list, dataset, max_seq_length, exp_output, tokenizer,
+                  bucket_lengths=None):
+    """(comprehensiveness scores, sufficiency scores) of the rationales, as the two get_cls_score calls with
+    remove_rations and extract_rations, from one tokenization pass and one prediction stream."""
+    features = ce_load_fused_bert_features(rationales, docs, label_list, max_seq_length, tokenizer)
+    scores = _predict_positive(model, features, dataset, max_seq_length, exp_output, bucket_lengths)
+    return scores[:len(rationales)], scores[len(rationales):]
+
+
+AOPC_THRESHOLDS = [0.01, 0.05, 0.1, 0.2, 0.5]
+
+
+def masks_to_spans(masks):
+    """(example, start, end) arrays of the runs of ones in a batch of (N, L) 0/1 masks, end exclusive, ordered
+    by example and start."""
+    masks = np.asarray(masks, dtype=np.int8)
+    padding = np.zeros((len(masks), 1), dtype=np.int8)
+    edges = np.diff(np.concatenate([padding, masks, padding], axis=1), axis=1)
+    example, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    return example, start, end
+
+
+def mask_to_spans(mask):
+    """[{'start_token', 'end_token'}] of the runs of ones in a 0/1 mask."""
+    _, start, end = masks_to_spans(np.asarray(mask).reshape((1, -1)))
+    return [{'start_token': int(s), 'end_token': int(e)} for s, e in zip(start, end)]
+
+
+def top_k_rations(soft_predictions, threshold):
+    """Spans of the top threshold share (rounded up) of the tokens by soft rationale score."""
+    count = int(np.ceil(threshold * len(soft_predictions)))
+    return mask_to_spans(pred_to_exp_mask(soft_predictions, count))
+
+
+def ce_load_aopc_bert_features(rationales, docs, label_list, max_seq_length, tokenizer, thresholds, sub='.'):
+    """Features of the comprehensiveness inputs of all rationales for each threshold in turn, followed by their
+    sufficiency inputs in the same order. The rationale at a threshold is the top share of the tokens by
+    soft_rationale_predictions; all bins are spliced from the same cached wordpieces."""
+    doc_pieces = _DocPieces(docs, tokenizer)
+    sub_pieces = doc_pieces.word(sub)
+    comprehensiveness_examples, sufficiency_examples = [], []
+    for threshold in thresholds:
+        for rational in rationales:
+            comprehensiveness, sufficiency = counterfactual_pieces(
+                doc_pieces(rational),
+                top_k_rations(rational['rationales'][0]['soft_rationale_predictions'], threshold),
+                sub_pieces)
+            comprehensiveness_examples.append(_counterfactual_example(rational, comprehensiveness))
+            sufficiency_examples.append(_counterfactual_example(rational, sufficiency))
+    return convert_examples_to_features(comprehensiveness_examples + sufficiency_examples,
+                                        label_list, max_seq_length, tokenizer)
+
+
+def get_aopc_scores(model, rationales, docs, label_list, dataset, max_seq_length, exp_output, tokenizer,
+                    thresholds=AOPC_THRESHOLDS, bucket_lengths=None):
+    """(comprehensiveness scores, sufficiency scores), each (len(thresholds), len(rationales), 2), of the top
+    soft rationale tokens at every threshold. All bins go through one prediction stream."""
+    features = ce_load_aopc_bert_features(rationales, docs, label_list, max_seq_length, tokenizer, thresholds)
+    scores = _predict_positive(model, features, dataset, max_seq_length, exp_output, bucket_lengths)
+    scores = scores.reshape((2, len(thresholds), len(rationales), 2))
+    return scores[0], scores[1]
+
+
 def add_cls_scores(res, cls, c, s, label_list):
     res['classification_scores'] = {label_list[0]: cls[0], label_list[1]: cls[1]}
     res['comprehensiveness_classification_scores'] = {label_list[0]: c[0], label_list[1]: c[1]}
@@ -118,44 +259,49 @@ def add_cls_scores(res, cls, c, s, label_list):
     return res
 
 
+def add_thresholded_scores(res, thresholds, c, s, label_list):
+    res['thresholded_scores'] = [{'threshold': threshold,
+                                  'comprehensiveness_classification_scores': {label_list[0]: _c[0],
+                                                                              label_list[1]: _c[1]},
+                                  'sufficiency_classification_scores': {label_list[0]: _s[0], label_list[1]: _s[1]}}
+                                 for threshold, _c, _s in zip(thresholds, c, s)]
+    return res
+
+
 def pred_to_exp_mask(exp_pred, count=None, threshold=0.5):
     if count is None:
         return (np.array(exp_pred) >= threshold).astype(np.int32)
-    temp = [(i, p) for i, p in enumerate(exp_pred)]
-    temp = sorted(temp, key=lambda x: x[1], reverse=True)
+    exp_pred = np.asarray(exp_pred)
     ret = np.zeros_like(exp_pred).astype(np.int32)
-    for i, _ in temp[:count]:
-        ret[i] = 1
+    if count >= len(exp_pred):
+        ret[:] = 1
+        return ret
+    if count <= 0:
+        return ret
+    # the count-th largest score; ties at it go to the lowest indices, as with a stable descending sort
+    kth = exp_pred[np.argpartition(exp_pred, len(exp_pred) - count)[len(exp_pred) - count]]
+    above = exp_pred > kth
+    ret[above] = 1
+    ret[np.flatnonzero(exp_pred == kth)[:count - np.count_nonzero(above)]] = 1
     return ret
 
 
 def rational_bits_to_ev_generator(token_list, raw_input, exp_pred, hard_selection_count, hard_selection_threshold):
-    in_rationale = False
     docid = list(extract_doc_ids_from_annotations([raw_input]))[0]
-    ev = {'docid': docid,
-          'start_token': -1, 'end_token': -1, 'text': ''}
     exp_masks = pred_to_exp_mask(
         exp_pred, hard_selection_count, hard_selection_threshold)
-    for i, p in enumerate(exp_masks):
-        if p == 0 and in_rationale:  # leave rational zone
-            in_rationale = False
-            ev['end_token'] = i
-            ev['text'] = ' '.join(
-                token_list[ev['start_token']: ev['end_token']])
-            yield deepcopy(ev)
-        elif p == 1 and not in_rationale:  # enter rational zone
-            in_rationale = True
-            ev['start_token'] = i
-    if in_rationale:  # the final non-padding token is rational
-        ev['end_token'] = len(exp_pred)
-        ev['text'] = ' '.join(token_list[ev['start_token']: ev['end_token']])
-        yield deepcopy(ev)
+    for span in mask_to_spans(exp_masks):
+        yield {'docid': docid,
+               'start_token': span['start_token'], 'end_token': span['end_token'],
+               'text': ' '.join(token_list[span['start_token']: span['end_token']])}
 
 
 # [SEP] == 102
 # [CLS] == 101
 # [PAD] == 0
 def extract_texts(tokens, exps=None, text_a=True, text_b=False):
+    if isinstance(tokens, np.ndarray):
+        tokens = tokens.tolist()
     if tokens[0] == 101:
         endp_text_a = tokens.index(102)
         if text_b:
@@ -182,19 +328,61 @@ def extract_texts(tokens, exps=None, text_a=True, text_b=False):
         return ret_token, ret_exps
 
 
+def rnr_matrices_to_spans(rnr_matrices):
+    """Decodes a batch of (N, L, L + 1) rnr matrices to its spans, one per predicted start.
+
+    Returns (example, start, end, weight) arrays: the rounded start score is the weight, and the end is the
+    argmax of the upper triangular end scores of the start row, inclusive.
+    """
+    starts = np.round(rnr_matrices[:, :, 0])
+    example, start = np.nonzero(starts)
+    weight = starts[example, start]
+    # only the rows with a start are decoded, with the end scores before the start zeroed as np.triu does
+    end_scores = rnr_matrices[example, start, 1:]
+    end_scores = np.where(np.arange(end_scores.shape[1]) >= start[:, np.newaxis], end_scores, 0)
+    end = np.argmax(end_scores * weight[:, np.newaxis], axis=1)
+    return example, start, end, weight
+
+
+def spans_to_rational_masks(spans, num_examples, length, dtype=np.float32):
+    """(num_examples, length) rational masks of (example, start, end, weight) spans: weight from start to end."""
+    example, start, end, weight = spans
+    edges = np.zeros((num_examples, length + 1), dtype=dtype)
+    np.add.at(edges, (example, start), weight)
+    np.add.at(edges, (example, end + 1), -weight)
+    return np.cumsum(edges, axis=1)[:, :length]
+
+
+def rnr_matrices_to_rational_masks(rnr_matrices):
+    rnr_matrices = np.asarray(rnr_matrices)
+    return spans_to_rational_masks(rnr_matrices_to_spans(rnr_matrices), len(rnr_matrices), rnr_matrices.shape[1],
+                                   dtype=rnr_matrices.dtype)
+
+
 def rnr_matrix_to_rational_mask(rnr_matrix):
-    start_logits, end_logits = rnr_matrix[:, :1], rnr_matrix[:, 1:]
-    starts = np.round(start_logits).reshape((-1, 1))
-    ends = np.triu(end_logits)
-    ends = starts * ends
-    ends_args = np.argmax(ends, axis=1)
-    ends = np.zeros_like(ends)
-    for i in range(len(ends_args)):
-        ends[i, ends_args[i]] = 1
-    ends = starts * ends
-    ends = np.sum(ends, axis=0, keepdims=True)
-    rational_mask = np.cumsum(starts.reshape((1, -1)), axis=1) - np.cumsum(ends, axis=1) + ends
-    return rational_mask
+    return rnr_matrices_to_rational_masks(np.asarray(rnr_matrix)[np.newaxis])
+
+
+def predict_rnr_rational_masks(model, inputs, batch_size=32):
+    """model.predict for a model whose last output is the rnr matrix, with that output decoded to (N, L) rational
+    masks. Every predicted batch is decoded to its spans right away, so the (N, L, L + 1) float matrices of the
+    whole split are never kept."""
+    num_examples = len(inputs[0])
+    outputs, spans = [], []
+    length = None
+    for batch_start in range(0, num_examples, batch_size):
+        batch_preds = model.predict_on_batch([np.asarray(x[batch_start: batch_start + batch_size]) for x in inputs])
+        if not isinstance(batch_preds, list):
+            batch_preds = [batch_preds]
+        rnr_matrices = np.asarray(batch_preds[-1])
+        length = rnr_matrices.shape[1]
+        example, start, end, weight = rnr_matrices_to_spans(rnr_matrices)
+        spans.append((example + batch_start, start, end, weight))
+        outputs.append(batch_preds[:-1])
+    spans = [np.concatenate(field) for field in zip(*spans)]
+    preds = [np.concatenate(output) for output in zip(*outputs)]
+    preds.append(spans_to_rational_masks(spans, num_examples, length))
+    return preds if len(preds) > 1 else preds[0]
 
 
 def pred_to_results(raw_input, input_ids, pred, \
@@ -202,7 +390,7 @@ def pred_to_results(raw_input, input_ids, pred, \
                     vocab, docs, label_list,
                     exp_output, tokenizer, identifier='mtl', fix_empty_evidence='doc'):
     cls_pred, exp_pred = pred
-    if exp_output == 'rnr':
+    if exp_output == 'rnr' and np.ndim(exp_pred) == 2:  # not yet decoded, see predict_rnr_rational_masks
         exp_pred = rnr_matrix_to_rational_mask(exp_pred)
     exp_pred = exp_pred.reshape((-1,)).tolist()
     try:
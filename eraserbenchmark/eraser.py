@@ -38,8 +38,14 @@ def evaluate(results_fname, dataset=dataset_name, split_name='test', train_on_po
     #results_fname = 'eraserbenchmark/annotated_by_exp/{}.jsonl'.format(model_name + '_' + split_name)
     #score_file = 'eraserbenchmark/outputs/{}.txt'.format(model_name + '_' + split_name)
     score_file = '/'.join(results_fname.split('/')[:-1]) + f'/benchmark_{split_name}.json'
+    results = []
     with open(results_fname + 'pkl3', 'rb') as fin:
-        results = pickle.load(fin)
+        # the results may be pickled in several chunks, see bert_cls_exp_gen
+        while True:
+            try:
+                results += pickle.load(fin)
+            except EOFError:
+                break
     docids = set(chain.from_iterable([rat['docid'] for rat in res['rationales']] for res in results))
     docs = load_flattened_documents(data_dir, docids)
     verify_instances(results, docs)
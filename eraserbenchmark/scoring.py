@@ -232,6 +232,26 @@ def score_classifications(instances: List[dict], annotations: List[Annotation],
         sufficiency_kl = None
         sufficiency_entropy = None
 
+    if 'thresholded_scores' in instances[0]:
+        # area over the perturbation curve: the score drops averaged over the bins of top soft rationale tokens
+        aopc_thresholds = [x['threshold'] for x in instances[0]['thresholded_scores']]
+        aopc_comprehensiveness_points = np.average([
+            [x['classification_scores'][x['classification']] - t['comprehensiveness_classification_scores'][
+                x['classification']] for t in x['thresholded_scores']] for x in instances], axis=0)
+        aopc_sufficiency_points = np.average([
+            [x['classification_scores'][x['classification']] - t['sufficiency_classification_scores'][
+                x['classification']] for t in x['thresholded_scores']] for x in instances], axis=0)
+        aopc_comprehensiveness = np.average(aopc_comprehensiveness_points)
+        aopc_sufficiency = np.average(aopc_sufficiency_points)
+        aopc_comprehensiveness_points = dict(zip(aopc_thresholds, aopc_comprehensiveness_points))
+        aopc_sufficiency_points = dict(zip(aopc_thresholds, aopc_sufficiency_points))
+    else:
+        aopc_thresholds = None
+        aopc_comprehensiveness = None
+        aopc_sufficiency = None
+        aopc_comprehensiveness_points = None
+        aopc_sufficiency_points = None
+
     if 'tokens_to_flip' in instances[0]:
         token_percentages = []
         for ann in annotations:
@@ -254,4 +274,9 @@ def score_classifications(instances: List[dict], annotations: List[Annotation],
         'comprehensiveness_kl': comprehensiveness_kl,
         'sufficiency_entropy': sufficiency_entropy,
         'sufficiency_kl': sufficiency_kl,
+        'aopc_thresholds': aopc_thresholds,
+        'comprehensiveness_aopc': aopc_comprehensiveness,
+        'comprehensiveness_aopc_points': aopc_comprehensiveness_points,
+        'sufficiency_aopc': aopc_sufficiency,
+        'sufficiency_aopc_points': aopc_sufficiency_points,
     }
@@ -84,7 +84,7 @@ from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.models import Model
 from tensorflow.keras.layers import Input, Dense, Reshape, Multiply, Concatenate, Dot, Lambda, Softmax
 from bert_utils import get_vocab
-from eraser_benchmark import pred_to_results
+from eraser_benchmark import pred_to_results, predict_rnr_rational_masks
 from metrices import *
 from losses import *
 
@@ -178,6 +178,7 @@ def build_model():
     return model, model_cls, model_exp
 
 LEARNING_RATE = 1e-5
+BATCH_SIZE = 10
 model, model_cls, model_exp = build_model()
 model.load_weights(f"model_checkpoints/emnlp2020/two_stages_{identifier}+cls/{identifier_model_name}/cp-{identifier_ckpt_num}.ckpt")
 
@@ -194,11 +195,14 @@ test_outputs['exp_output'] = test_rations
 val_outputs['exp_output'] = val_rations
 
 # expred-stage-1
-print(model.evaluate(x=test_inputs, y=test_outputs, batch_size=10, verbose=1))
+print(model.evaluate(x=test_inputs, y=test_outputs, batch_size=BATCH_SIZE, verbose=1))
 
 # annotated test for the 2nd stage
 benchmark_inputs, raw_input, benchmark_input_ids, benchmark_outputs = test_inputs, test, test_input_ids, test_outputs
-pred = model.predict(x=benchmark_inputs)
+if exp_structure == 'rnr':
+    pred = predict_rnr_rational_masks(model, benchmark_inputs, batch_size=BATCH_SIZE)
+else:
+    pred = model.predict(x=benchmark_inputs)
 if exp_only:
     cls_pred = np.array([[1] for i in pred])
     exp_pred = pred
@@ -210,41 +214,9 @@ from itertools import chain
 from eraserbenchmark.rationale_benchmark.utils import load_documents
 docids = set(chain.from_iterable(extract_doc_ids_from_annotations(d) for d in [train, val, test]))
 docs = load_documents(f'/home/zzhang/.keras/datasets/{dataset}', docids)
-from bert.tokenization import FullTokenizer, BasicTokenizer, \
-    convert_to_unicode, whitespace_tokenize, convert_ids_to_tokens
-
-
-import tensorflow_hub as hub
-from bert_with_ration_eraser import BasicTokenizerWithRation
+from bert_with_ration_eraser import FullTokenizerWithRations
 gpu_id = '0'
 
-class FullTokenizerWithRations(FullTokenizer):  # Test passed :)
-    def __init__(self, vocab_file, do_lower_case=True):
-        self.basic_rational_tokenizer = BasicTokenizerWithRation(do_lower_case=do_lower_case)
-        super(FullTokenizerWithRations, self).__init__(vocab_file, do_lower_case)
-    def tokenize(self, text, evidences=None):
-        split_tokens = []
-        split_rations = []
-        for token, ration in self.basic_rational_tokenizer.tokenize(text, evidences):
-            for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                split_tokens.append(sub_token)
-                split_rations.append(ration)
-        return list(zip(split_tokens, split_rations))
-    @classmethod
-    def create_tokenizer_from_hub_module(self, gpu_id):
-        """Get the vocab file and casing info from the Hub module."""
-        with tf.Graph().as_default():  # basically useless, but good practice to specify the graph using, even it sets the default graph as the default graph
-            bert_module = hub.Module(BERT_MODEL_HUB)
-            tokenization_info = bert_module(signature="tokenization_info", as_dict=True)
-            config = tf.ConfigProto()
-            config.gpu_options.allow_growth = True
-            config.gpu_options.visible_device_list = gpu_id
-            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
-            with tf.Session(
-                    config=config) as sess:  # create a new session, with session we can setup even remote computation
-                vocab_file, do_lower_case = sess.run([tokenization_info["vocab_file"],
-                                                      tokenization_info["do_lower_case"]])
-        return FullTokenizerWithRations(vocab_file=vocab_file, do_lower_case=do_lower_case)
 full_tokenizer = FullTokenizerWithRations.create_tokenizer_from_hub_module(gpu_id)
 
 results = [pred_to_results(raw_input[i], benchmark_input_ids[i],
@@ -271,20 +243,15 @@ with open(exp_output_fname, 'w+') as fout:
 
 # benchmark result for the first stage
 
-from eraser_benchmark import get_cls_score
-from eraser_benchmark import remove_rations, extract_rations
+from eraser_benchmark import get_cs_scores
 
 exp_structure = 'gru'
 if identifier == 'mtl':
     pred_softmax = np.hstack([1 - cls_pred, cls_pred])
     
 
-    c_pred_softmax = get_cls_score(
-        model, results, docs, label_list, dataset, remove_rations, MAX_SEQ_LENGTH, exp_structure,
-        gpu_id=gpu_id, tokenizer=full_tokenizer)
-    s_pred_softmax = get_cls_score(
-        model, results, docs, label_list, dataset, extract_rations, MAX_SEQ_LENGTH, exp_structure,
-        gpu_id=gpu_id, tokenizer=full_tokenizer)
+    c_pred_softmax, s_pred_softmax = get_cs_scores(
+        model, results, docs, label_list, dataset, MAX_SEQ_LENGTH, exp_structure, tokenizer=full_tokenizer)
 
     from eraser_benchmark import add_cls_scores
     results = [add_cls_scores(res,
@@ -332,7 +299,7 @@ model_cls_only, model_cls_cls_only, model_exp_cls_only = build_model()
 model_cls_only.load_weights(f'model_checkpoints/emnlp2020/two_stages_{identifier}+cls/{classifier_model_name}/cp-{classifier_ckpt_num}.ckpt')
 
 # prepare for the data for the cls only model
-from eraser_benchmark import flatten_rations
+from eraser_benchmark import flatten_rations, extract_rations
 def extract_rations_collapse_wildcards(sentence, rations, tokenizer=None, \
                                        sub='.', combine_subtokens=False, \
                                        rep_count=0):
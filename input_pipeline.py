@@ -0,0 +1,76 @@
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+tf.disable_v2_behavior()
+
+from bucketing import bucket_of, make_batches
+from bert_data_preprocessing_rational_eraser import unpack_rations
+
+# field positions in a split of the feature store, see convert_bert_features
+INPUT_IDS, INPUT_MASKS, SEGMENT_IDS, RATIONS, LABELS = range(5)
+
+
+def _batch_loader(features, output_names, exp_output, max_seq_length):
+    def load(length, index):
+        x = [np.asarray(features[field][index])[:, :length].astype(np.float32)
+             for field in (INPUT_IDS, INPUT_MASKS, SEGMENT_IDS)]
+        y = []
+        for name in output_names:
+            if name == 'cls_output':
+                y.append(np.asarray(features[LABELS][index]).astype(np.float32))
+            else:
+                rations = unpack_rations(np.asarray(features[RATIONS][index]), exp_output, max_seq_length)
+                y.append(rations[:, :length].astype(np.float32))
+        return tuple(x + y)
+
+    return load
+
+
+def feature_dataset(features, output_names, batch_size, exp_output='gru', shuffle=False, bucket_lengths=None,
+                    max_seq_length=512, seed=None, num_parallel_calls=tf.data.experimental.AUTOTUNE):
+    """A repeated tf.data pipeline over one split of the feature store, returns (dataset, steps per epoch).
+
+    features is the split as loaded from the npy shards, [input_ids, input_masks, segment_ids, packed rations,
+    labels], memory-mapped. Only batches of example indices flow through the pipeline: a batch is gathered from
+    the shards and its rationale bits are unpacked in a parallel map, and the next batches are prefetched while
+    the model runs. So neither the inputs nor the unpacked targets of the split ever have to be in memory.
+
+    output_names are model output names ('cls_output', 'exp_output'); a single name yields its target array,
+    a list yields a dict of targets. The order of the examples is reshuffled every epoch if shuffle is set,
+    and batches are cut to length buckets if bucket_lengths is given, as in bucketing.BucketedSequence.
+    """
+    single_output = isinstance(output_names, str)
+    if single_output:
+        output_names = [output_names]
+    if bucket_lengths is None:
+        bucket_lengths = [max_seq_length]
+    buckets = bucket_of(features[INPUT_MASKS], bucket_lengths)
+    random_state = np.random.RandomState(seed)
+    num_batches = len(make_batches(buckets, bucket_lengths, batch_size))
+
+    def batch_indices():
+        # called again for every pass over the split, i.e. a new order every epoch
+        for length, index in make_batches(buckets, bucket_lengths, batch_size, shuffle, random_state):
+            yield length, index
+
+    load = _batch_loader(features, output_names, exp_output, max_seq_length)
+    input_length = max_seq_length if len(bucket_lengths) == 1 else None
+
+    def load_batch(length, index):
+        tensors = tf.numpy_function(load, [length, index], [tf.float32] * (3 + len(output_names)))
+        x, y = tensors[:3], tensors[3:]
+        for tensor in x:
+            tensor.set_shape([None, input_length])
+        for name, tensor in zip(output_names, y):
+            tensor.set_shape([None, 1] if name == 'cls_output' else
+                             [None, input_length, 2 if exp_output == 'interval' else 1])
+        if single_output:
+            return tuple(x), y[0]
+        return tuple(x), dict(zip(output_names, y))
+
+    dataset = tf.data.Dataset.from_generator(batch_indices, output_types=(tf.int64, tf.int64),
+                                             output_shapes=((), (None,)))
+    dataset = dataset.repeat()
+    dataset = dataset.map(load_batch, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset, num_batches
@@ -72,10 +72,10 @@ class BertLayer(tf.keras.layers.Layer):
         bert_inputs = dict(
             input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids
         )
-        cls = self.bert(inputs=bert_inputs, signature="tokens",
-                        as_dict=True)["pooled_output"]
-        exp = self.bert(inputs=bert_inputs, signature="tokens",
-                        as_dict=True)["sequence_output"]
+        # one application of the module, both outputs come from the same forward pass
+        bert_outputs = self.bert(inputs=bert_inputs, signature="tokens", as_dict=True)
+        cls = bert_outputs["pooled_output"]
+        exp = bert_outputs["sequence_output"]
 
         def mul_mask(x, m): return x * tf.expand_dims(m, axis=-1)
 
@@ -0,0 +1,108 @@
+import hashlib
+import pickle
+import time
+
+import os
+
+
+# a put writes its .tmp file within seconds, older ones were left by an interrupted put
+STALE_TMP_SECONDS = 10 * 60
+
+
+def _cache_files(cache_dir):
+    for root, _, fnames in os.walk(cache_dir):
+        for fname in fnames:
+            path = os.path.join(root, fname)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # evicted or renamed by another process in the meantime
+                continue
+            yield path, stat.st_mtime, stat.st_size
+
+
+def evict_lru(cache_dir, max_bytes):
+    """Deletes the least recently used files under cache_dir until it takes at most max_bytes.
+
+    A file's modification time serves as its last access time; readers touch the files they hit.
+    '.tmp' files still being written are left alone, stale ones are deleted first. Returns the number
+    of bytes freed.
+    """
+    stale_before = time.time() - STALE_TMP_SECONDS
+    files, freed = [], 0
+    for path, mtime, size in _cache_files(cache_dir):
+        if not path.endswith('.tmp'):
+            files.append((path, mtime, size))
+        elif mtime < stale_before:
+            try:
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+    files.sort(key=lambda x: x[1])
+    total = sum(size for _, _, size in files)
+    for path, _, size in files:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        freed += size
+    return freed
+
+
+def normalize_text(text):
+    if isinstance(text, (list, tuple)):
+        return ' '.join(text)
+    return ' '.join(text.split())
+
+
+class PredictionCache(object):
+    """Disk-backed, size-bounded LRU cache of ExPred predictions.
+
+    Entries are keyed by a hash of the whitespace-normalized claim, the evidence and model_id (which
+    should identify the checkpoint), and are pickled one per file under cache_dir. The cache can be
+    shared between processes.
+    """
+
+    def __init__(self, cache_dir, model_id, max_bytes=1 << 30, evict_every=1000):
+        self.cache_dir = cache_dir
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._puts = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, query, evidence):
+        content = '\n'.join([self.model_id, normalize_text(query), normalize_text(evidence)])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def get(self, query, evidence):
+        path = self._path(self.key(query, evidence))
+        try:
+            with open(path, 'rb') as fin:
+                value = pickle.load(fin)
+            now = time.time()
+            os.utime(path, (now, now))
+            return value
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, query, evidence, value):
+        path = self._path(self.key(query, evidence))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fout:
+            pickle.dump(value, fout)
+        os.replace(tmp_path, path)
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        return evict_lru(self.cache_dir, self.max_bytes)
@@ -0,0 +1,59 @@
+import pandas as pd
+
+from shortcut_evaluation import load_pattern_file
+
+
+def run_substitution_attack(evaluator, pattern, substring, replacements, n=None):
+    """Replaces substring by every candidate in replacements and reports how often the prediction flips.
+
+    All perturbed claims of all replacements are deduplicated together with the original claims and
+    evaluated in one batched stream. Every distinct evidence is tokenized once and shared by all the
+    claims that are paired with it, so its variants are batched next to each other.
+
+    Returns (report, rows): report has one line per replacement with the number of attacked claims
+    (those containing substring), the number of flipped predictions and the flip rate; rows holds the
+    prediction of every original and perturbed claim.
+    """
+    evaluations = load_pattern_file(pattern)
+    if n is not None:
+        evaluations = evaluations[:n]
+
+    evidence_tokens = {}
+    pair_ids = {}
+    queries, evidences = [], []
+
+    def pair_id(query, evidence):
+        key = (query, evidence)
+        if key not in pair_ids:
+            if evidence not in evidence_tokens:
+                evidence_tokens[evidence] = evidence.split()
+            pair_ids[key] = len(queries)
+            queries.append(query.split())
+            evidences.append(evidence_tokens[evidence])
+        return pair_ids[key]
+
+    rows = {'replacement': [], 'query': [], 'evidences': [], 'original_pair': [], 'perturbed_pair': []}
+    for query, evidence in zip(evaluations['query'], evaluations['evidences']):
+        original = pair_id(query, evidence)
+        if substring not in query:
+            continue
+        for replacement in replacements:
+            perturbed_query = query.replace(substring, replacement)
+            rows['replacement'].append(replacement)
+            rows['query'].append(perturbed_query)
+            rows['evidences'].append(evidence)
+            rows['original_pair'].append(original)
+            rows['perturbed_pair'].append(pair_id(perturbed_query, evidence))
+
+    labels, _ = evaluator.evaluate_tokenized(queries, evidences)
+
+    rows = pd.DataFrame(rows)
+    rows['original_label'] = [labels[i] for i in rows['original_pair']]
+    rows['label'] = [labels[i] for i in rows['perturbed_pair']]
+    rows['flipped'] = rows['label'] != rows['original_label']
+    rows = rows.drop(columns=['original_pair', 'perturbed_pair'])
+
+    report = rows.groupby('replacement', sort=False)['flipped'].agg(['size', 'sum']).reindex(replacements)
+    report = report.fillna(0).astype(int).rename(columns={'size': 'attacked', 'sum': 'flipped'})
+    report['flip_rate'] = (100 * report['flipped'] / report['attacked'].clip(lower=1))
+    return report.reset_index(), rows
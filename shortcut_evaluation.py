@@ -0,0 +1,123 @@
+import pandas as pd
+
+DEFAULT_LABELS = ['SUPPORTS', 'REFUTES']
+
+
+def load_pattern_file(pattern):
+    """Reads a shortcut pattern subset (e.g. 'is_not_a.json') into a DataFrame.
+
+    `pattern` may also be a DataFrame with 'query' and 'evidences' columns already loaded.
+    Rows with an empty query are dropped, the same way the notebooks skip them.
+    """
+    if isinstance(pattern, pd.DataFrame):
+        evaluations = pattern
+    else:
+        evaluations = pd.read_json(pattern)
+    evaluations = evaluations[evaluations['query'].astype(bool)]
+    return evaluations.reset_index(drop=True)
+
+
+def _cls_probabilities(expred_output):
+    cls_pred = expred_output['cls_preds']['cls_pred']
+    if hasattr(cls_pred, 'detach'):
+        cls_pred = cls_pred.detach().cpu().numpy()
+    return [list(map(float, p)) for p in cls_pred]
+
+
+def _soft_rationales(expred_output, lengths):
+    """Per-token rationale scores of every row, trimmed from the batch-padded length to the row's own length."""
+    exp_pred = expred_output.get('mtl_preds', {}).get('exp_pred')
+    if exp_pred is None:
+        return [None] * len(lengths)
+    if hasattr(exp_pred, 'detach'):
+        exp_pred = exp_pred.detach().cpu().numpy()
+    return [list(map(float, p[:length])) for p, length in zip(exp_pred, lengths)]
+
+
+class ExpredBatchEvaluator(object):
+    """Runs ExPred over many (claim, evidence) pairs at once instead of one ExpredInput per row.
+
+    Pairs are sorted by length before batching, so that every batch is padded to roughly the
+    same length, and the predictions are returned in the original order. If a PredictionCache is
+    given, pairs already scored by the same checkpoint are read from it instead of being re-run.
+    """
+
+    def __init__(self, expred, expred_config, span_tokenizer, labels=None, batch_size=32, cache=None):
+        self.expred = expred
+        self.expred_config = expred_config
+        self.span_tokenizer = span_tokenizer
+        self.labels = DEFAULT_LABELS if labels is None else list(labels)
+        self.batch_size = batch_size
+        self.cache = cache
+
+    def _input_length(self, query, evidence):
+        """Wordpieces of '[CLS] query [SEP] evidence [SEP]', the unpadded length of the pair's model input."""
+        return len(self.span_tokenizer.tokenize(' '.join(query))) + \
+            len(self.span_tokenizer.tokenize(' '.join(evidence))) + 3
+
+    def _predict_batch(self, queries, evidences, ann_ids):
+        from src.expred import ExpredInput
+        import torch
+
+        expred_input = ExpredInput(
+            queries=queries,
+            docs=evidences,
+            labels=self.labels,
+            config=self.expred_config,
+            ann_ids=ann_ids,
+            span_tokenizer=self.span_tokenizer)
+        expred_input.preprocess()
+        with torch.no_grad():
+            expred_output = self.expred(expred_input)
+        return (expred_input.get_decoded_cls_preds(expred_output),
+                _cls_probabilities(expred_output),
+                _soft_rationales(expred_output, [self._input_length(q, e) for q, e in zip(queries, evidences)]))
+
+    def evaluate(self, queries, evidences):
+        """Returns (labels, probabilities) for every (query, evidence) pair, in input order."""
+        return self.evaluate_tokenized([q.split() for q in queries], [e.split() for e in evidences])
+
+    def evaluate_tokenized(self, queries, evidences, return_rationales=False):
+        labels, probabilities, rationales = [None] * len(queries), [None] * len(queries), [None] * len(queries)
+        todo = []
+        for i in range(len(queries)):
+            cached = None if self.cache is None else self.cache.get(queries[i], evidences[i])
+            if cached is None:
+                todo.append(i)
+            else:
+                labels[i], probabilities[i], rationales[i] = \
+                    cached['label'], cached['probabilities'], cached['soft_rationale']
+
+        # pairs of equal length that share an evidence end up next to each other in the same batch
+        order = sorted(todo, key=lambda i: (len(queries[i]) + len(evidences[i]), id(evidences[i])))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start: start + self.batch_size]
+            batch_preds = self._predict_batch(
+                [queries[i] for i in batch],
+                [evidences[i] for i in batch],
+                ['batch_{}'.format(i) for i in batch])
+            for i, label, prob, rationale in zip(batch, *batch_preds):
+                labels[i], probabilities[i], rationales[i] = label, prob, rationale
+                if self.cache is not None:
+                    self.cache.put(queries[i], evidences[i],
+                                   {'label': label, 'probabilities': prob, 'soft_rationale': rationale})
+        if return_rationales:
+            return labels, probabilities, rationales
+        return labels, probabilities
+
+    def evaluate_pattern(self, pattern, n=None):
+        """Evaluates a whole pattern file or DataFrame, optionally only its first n rows.
+
+        The returned DataFrame has the 'query', 'evidences' and predicted 'label' columns plus
+        one probability column per class label.
+        """
+        evaluations = load_pattern_file(pattern)
+        if n is not None:
+            evaluations = evaluations[:n]
+        labels, probabilities = self.evaluate(list(evaluations['query']), list(evaluations['evidences']))
+        df = pd.DataFrame({'query': evaluations['query'],
+                           'evidences': evaluations['evidences'],
+                           'label': labels})
+        for label_id, label in enumerate(self.labels):
+            df['prob_' + label] = [p[label_id] for p in probabilities]
+        return df
@@ -0,0 +1,146 @@
+import argparse
+import glob
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import os
+
+from shortcut_attack import run_substitution_attack
+from shortcut_evaluation import ExpredBatchEvaluator, load_pattern_file
+
+_evaluator = None
+
+
+def discover_pattern_files(pattern_dir):
+    """Every '*.json' in pattern_dir holding a list of {query, evidences} rows, e.g. 'is_not_a.json'."""
+    fnames = []
+    for fname in sorted(glob.glob(os.path.join(pattern_dir, '*.json'))):
+        try:
+            with open(fname, 'r') as fin:
+                content = json.load(fin)
+        except (ValueError, UnicodeDecodeError):
+            continue
+        if isinstance(content, list) and len(content) > 0 and isinstance(content[0], dict) \
+                and {'query', 'evidences'} <= set(content[0].keys()):
+            fnames.append(fname)
+    return fnames
+
+
+def subsequence_of(fname):
+    return os.path.splitext(os.path.basename(fname))[0].replace('_', ' ')
+
+
+def _init_worker(batch_size, cache_dir, num_threads):
+    # one ExPred instance per worker process, set up as in the shortcut notebooks
+    global _evaluator
+    import torch
+    from src.expred import seeding, BertTokenizerWithSpans, ExpredConfig, Expred
+
+    torch.set_num_threads(num_threads)
+    expred_config = ExpredConfig(
+        pretrained_dataset_name='fever',
+        base_dataset_name='fever',
+        device='cpu',
+        load_from_pretrained=True)
+    seeding(1234)
+    tokenizer = BertTokenizerWithSpans.from_pretrained('bert-base-uncased')
+    expred = Expred.from_pretrained(expred_config)
+    expred.eval()
+    cache = None
+    if cache_dir is not None:
+        from prediction_cache import PredictionCache
+        cache = PredictionCache(cache_dir, model_id='expred_fever_pretrained')
+    _evaluator = ExpredBatchEvaluator(expred, expred_config, tokenizer, cache=cache, batch_size=batch_size)
+
+
+def evaluate_pattern_file(fname, attacks, max_rows):
+    subsequence = subsequence_of(fname)
+    evaluations = load_pattern_file(fname)
+    if max_rows is not None:
+        evaluations = evaluations[:max_rows]
+    df = _evaluator.evaluate_pattern(evaluations)
+    prediction_class, class_count = Counter(df['label']).most_common(1)[0]
+    res = {'subsequence': subsequence,
+           'pattern_file': os.path.basename(fname),
+           'num_rows': len(df),
+           'prediction_class': prediction_class,
+           'relative_support': 100 * class_count / len(df),
+           'predictions': list(zip(df['query'], df['label'])),
+           'success_rate': None}
+    if subsequence in attacks:
+        report, _ = run_substitution_attack(_evaluator, evaluations, subsequence, attacks[subsequence])
+        res['attacks'] = report.to_dict(orient='records')
+        if report['attacked'].sum() > 0:
+            res['success_rate'] = 100 * report['flipped'].sum() / report['attacked'].sum()
+    return res
+
+
+def precision(res, gold_labels):
+    # share of the claims predicted as the pattern's class whose FEVER label agrees
+    judged = [gold_labels[q] for q, label in res['predictions']
+              if label == res['prediction_class'] and q in gold_labels]
+    if len(judged) == 0:
+        return None
+    return 100 * sum(l == res['prediction_class'] for l in judged) / len(judged)
+
+
+def _fmt(value):
+    return '-' if value is None else '{:.1f}%'.format(value)
+
+
+def to_markdown(results, pattern_dir):
+    lines = ['| Subsequence | Prediction Class | Relative Support | Precision | Success-rate |',
+             '|--------------|-----------|-----------|-----------|-----------|']
+    for res in results:
+        name = res['subsequence']
+        notebook = os.path.splitext(res['pattern_file'])[0] + '.ipynb'
+        if os.path.isfile(os.path.join(pattern_dir, notebook)):
+            name = '[{}]({})'.format(name, notebook)
+        lines.append('| {} | {} | {} | {} | {} |'.format(
+            name, res['prediction_class'], _fmt(res['relative_support']),
+            _fmt(res['precision']), _fmt(res['success_rate'])))
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pattern_dir', type=str, default='.')
+    parser.add_argument('--attacks', type=str, default=None)  # json: {"is not a": ["is also a"], ...}
+    parser.add_argument('--data_dir', type=str, default=None)  # fever dir, for the precision column
+    parser.add_argument('--max_rows', type=int, default=None)
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='worker processes, each loading its own ExPred model (about 0.5 GB of '
+                             'weights plus activations per worker); raise it only as far as memory allows')
+    parser.add_argument('--num_threads', type=int, default=1)  # torch threads per worker
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--cache_dir', type=str, default=None)
+    parser.add_argument('--output_md', type=str, default='shortcut_report.md')
+    parser.add_argument('--output_json', type=str, default='shortcut_report.json')
+    args = parser.parse_args()
+
+    attacks = {}
+    if args.attacks is not None:
+        with open(args.attacks, 'r') as fin:
+            attacks = json.load(fin)
+    gold_labels = {}
+    if args.data_dir is not None:
+        from eraserbenchmark.rationale_benchmark.utils import load_datasets
+        for split in load_datasets(args.data_dir):
+            gold_labels.update({ann.query: ann.classification for ann in split})
+
+    fnames = discover_pattern_files(args.pattern_dir)
+    print('evaluating {} pattern files on {} workers'.format(len(fnames), args.num_workers))
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_init_worker,
+                             initargs=(args.batch_size, args.cache_dir, args.num_threads)) as executor:
+        futures = [executor.submit(evaluate_pattern_file, fname, attacks, args.max_rows) for fname in fnames]
+        results = [f.result() for f in futures]
+
+    for res in results:
+        res['precision'] = precision(res, gold_labels)
+        del res['predictions']
+    with open(args.output_md, 'w') as fout:
+        fout.write(to_markdown(results, args.pattern_dir))
+    with open(args.output_json, 'w') as fout:
+        json.dump(results, fout, indent=2)
+    print(to_markdown(results, args.pattern_dir))
@@ -0,0 +1,182 @@
+import argparse
+import json
+import re
+from collections import Counter, defaultdict
+
+import os
+
+from eraserbenchmark.rationale_benchmark.utils import load_datasets
+
+token_pattern = re.compile(r"[\w']+")
+
+
+def tokenize_claim(query, lowercase=True):
+    if lowercase:
+        query = query.lower()
+    return token_pattern.findall(query)
+
+
+def _absolute_support(min_support, num_sequences):
+    if isinstance(min_support, float) and min_support < 1:
+        return max(1, int(round(min_support * num_sequences)))
+    return int(min_support)
+
+
+def _project_items(sequences):
+    # inverted index: item -> {seq_id: [positions]}, i.e. the projected database of every 1-pattern
+    projected = defaultdict(dict)
+    for seq_id, seq in enumerate(sequences):
+        for pos, item in enumerate(seq):
+            projected[item].setdefault(seq_id, []).append(pos)
+    return projected
+
+
+def _extend(sequences, projected, max_gap, frequent_items):
+    # grow every embedding of the current pattern by one item at most max_gap tokens after its end
+    extensions = defaultdict(dict)
+    for seq_id, ends in projected.items():
+        seq = sequences[seq_id]
+        for end in ends:
+            for pos in range(end + 1, min(len(seq), end + max_gap + 2)):
+                item = seq[pos]
+                if item in frequent_items:
+                    extensions[item].setdefault(seq_id, set()).add(pos)
+    return {item: {seq_id: sorted(ends) for seq_id, ends in proj.items()}
+            for item, proj in extensions.items()}
+
+
+def iter_frequent_subsequences(sequences, min_support, max_gap=0, max_length=5):
+    """Yields (pattern, seq_ids) for every gapped subsequence that occurs in at least min_support sequences.
+
+    Mining is a depth-first pattern growth over projected databases (PrefixSpan with a gap constraint):
+    each pattern keeps, per sequence, the positions where one of its embeddings ends, so extending it only
+    looks at the max_gap + 1 tokens following those positions instead of rescanning the sequences.
+    max_gap=0 restricts the miner to contiguous n-grams. min_support may be an absolute count or a fraction.
+    """
+    min_support = _absolute_support(min_support, len(sequences))
+    item_projections = _project_items(sequences)
+    frequent_items = {item for item, proj in item_projections.items() if len(proj) >= min_support}
+
+    stack = [((item,), item_projections[item]) for item in sorted(frequent_items, reverse=True)]
+    while len(stack) > 0:
+        pattern, projected = stack.pop()
+        yield pattern, sorted(projected.keys())
+        if len(pattern) >= max_length:
+            continue
+        extensions = _extend(sequences, projected, max_gap, frequent_items)
+        for item in sorted(extensions.keys(), reverse=True):
+            if len(extensions[item]) >= min_support:
+                stack.append((pattern + (item,), extensions[item]))
+
+
+def mine_frequent_subsequences(sequences, min_support, max_gap=0, max_length=5, min_length=1):
+    return {pattern: seq_ids
+            for pattern, seq_ids in iter_frequent_subsequences(sequences, min_support, max_gap, max_length)
+            if len(pattern) >= min_length}
+
+
+def iter_discriminative_patterns(sequences, labels, min_support, max_gap=0, max_length=5, min_length=1,
+                                 min_confidence=0., xor=False):
+    """Mines the claims of every label in a single pass and yields the support statistics of each pattern.
+
+    Support is counted per label from the projected database of the pattern, so the Refuted and Supported
+    pattern sets never have to be mined and diffed separately. Since a pattern that is frequent within one
+    label is frequent over all claims as well, nothing is lost by mining the union. With xor=True only the
+    patterns that are frequent (>= min_support) in exactly one label are kept, as in steps 1-3 of the README.
+
+    All statistics are over the given (gold) labels: label_confidence is the share of the claims containing the
+    pattern that carry its majority label. The README's Relative Support is over ExPred's predicted labels
+    instead, and is measured by shortcut_report on the mined pattern files.
+    """
+    label_counts = Counter(labels)
+    abs_min_support = _absolute_support(min_support, len(sequences))
+    for pattern, seq_ids in iter_frequent_subsequences(sequences, abs_min_support, max_gap, max_length):
+        if len(pattern) < min_length:
+            continue
+        support = Counter(labels[i] for i in seq_ids)
+        if xor and sum(s >= abs_min_support for s in support.values()) != 1:
+            continue
+        prediction_class, class_support = support.most_common(1)[0]
+        label_confidence = class_support / len(seq_ids)
+        if label_confidence < min_confidence:
+            continue
+        yield {'pattern': ' '.join(pattern),
+               'prediction_class': prediction_class,
+               'support': len(seq_ids),
+               'label_support': {label: support.get(label, 0) for label in label_counts},
+               'label_confidence': label_confidence,
+               'lift': label_confidence / (label_counts[prediction_class] / len(sequences)),
+               'seq_ids': seq_ids}
+
+
+def rank_discriminative_patterns(sequences, labels, min_support, max_gap=0, max_length=5, min_length=1,
+                                 min_confidence=0., xor=False):
+    patterns = iter_discriminative_patterns(sequences, labels, min_support, max_gap, max_length, min_length,
+                                            min_confidence, xor)
+    return sorted(patterns, key=lambda x: (-x['label_confidence'], -x['lift'], -x['support'], x['pattern']))
+
+
+def pattern_fname(pattern):
+    return '_'.join(pattern) + '.json'
+
+
+def annotations_to_pattern_rows(annotations):
+    # one row per evidence, the {query, evidences} shape read by the shortcut notebooks
+    rows = []
+    for ann in annotations:
+        for ev in ann.all_evidences():
+            rows.append({'query': ann.query, 'evidences': ev.text})
+    return rows
+
+
+def write_pattern_subsets(patterns, annotations, output_dir):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for pattern, seq_ids in patterns.items():
+        rows = annotations_to_pattern_rows(annotations[i] for i in seq_ids)
+        with open(os.path.join(output_dir, pattern_fname(pattern)), 'w') as fout:
+            json.dump(rows, fout, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str)
+    parser.add_argument('--split', type=str, default='train', choices='train val test'.split())
+    parser.add_argument('--label', type=str, default=None)  # e.g. REFUTES, mine every claim if not given
+    parser.add_argument('--min_support', type=float, default=20)
+    parser.add_argument('--max_gap', type=int, default=0)
+    parser.add_argument('--max_length', type=int, default=4)
+    parser.add_argument('--min_length', type=int, default=2)
+    parser.add_argument('--top_k', type=int, default=None)
+    parser.add_argument('--output_dir', type=str, default='mined_patterns')
+    parser.add_argument('--discriminative', action='store_true')  # count support per label in one pass
+    parser.add_argument('--min_confidence', type=float, default=0.)
+    parser.add_argument('--xor', action='store_true')
+    args = parser.parse_args()
+
+    train, val, test = load_datasets(args.data_dir)
+    annotations = {'train': train, 'val': val, 'test': test}[args.split]
+    if args.label is not None:
+        annotations = [ann for ann in annotations if ann.classification == args.label]
+    min_support = args.min_support if args.min_support < 1 else int(args.min_support)
+
+    sequences = [tokenize_claim(ann.query) for ann in annotations]
+    if args.discriminative:
+        ranked = rank_discriminative_patterns(sequences, [ann.classification for ann in annotations],
+                                              min_support, args.max_gap, args.max_length, args.min_length,
+                                              args.min_confidence, args.xor)
+        if args.top_k is not None:
+            ranked = ranked[:args.top_k]
+        patterns = {tuple(stats['pattern'].split()): stats.pop('seq_ids') for stats in ranked}
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        with open(os.path.join(args.output_dir, 'patterns.json'), 'w') as fout:
+            json.dump(ranked, fout, indent=2)
+    else:
+        patterns = mine_frequent_subsequences(sequences, min_support, args.max_gap, args.max_length,
+                                              args.min_length)
+        if args.top_k is not None:
+            top = sorted(patterns.items(), key=lambda x: (-len(x[1]), x[0]))[:args.top_k]
+            patterns = dict(top)
+    print('{} patterns mined from {} claims'.format(len(patterns), len(sequences)))
+    write_pattern_subsets(patterns, annotations, args.output_dir)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+# the modules of this repo are top-level scripts, importable from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '.', ',', 'the', 'cat', 'sat', 'on', 'mat', 'is', 'a', 'dog', 'play',
+         '##ing', '##s', 'froome', 'cyclist', 'born', 'in', '1985', 'kenya', 'who', 'was']
+
+
+@pytest.fixture(scope='session')
+def vocab_file(tmp_path_factory):
+    """A tiny BERT vocab, also picked up by bert_utils.get_tokenizer through BERT_VOCAB_FILE."""
+    path = tmp_path_factory.mktemp('bert') / 'vocab.txt'
+    path.write_text('\n'.join(VOCAB) + '\n')
+    os.environ['BERT_VOCAB_FILE'] = str(path)
+    return str(path)
+
+
+@pytest.fixture(scope='session')
+def tokenizer(vocab_file):
+    from bert_with_ration_eraser import FullTokenizerWithRations
+    return FullTokenizerWithRations(vocab_file, do_lower_case=True)
@@ -0,0 +1,38 @@
+import pytest
+
+import bert_utils
+
+
+@pytest.fixture
+def no_local_vocab(monkeypatch, tmp_path):
+    monkeypatch.setattr(bert_utils, '_resolved_vocabs', dict())
+    monkeypatch.delenv('BERT_VOCAB_FILE', raising=False)
+    monkeypatch.delenv('BERT_VOCAB_FROM_HUB', raising=False)
+    monkeypatch.setenv('TFHUB_CACHE_DIR', str(tmp_path / 'tfhub_modules'))
+    calls = []
+
+    def fake_vocab_from_hub_module(bert_model_hub, session_config):
+        calls.append(session_config)
+        return str(tmp_path / 'vocab.txt'), True
+
+    monkeypatch.setattr(bert_utils, '_vocab_from_hub_module', fake_vocab_from_hub_module)
+    return calls
+
+
+def test_local_vocab_builds_no_session_config(no_local_vocab, monkeypatch, vocab_file):
+    monkeypatch.setattr(bert_utils, 'gpu_session_config', None)  # fails if called
+    assert bert_utils.resolve_vocab(vocab_file, gpu_id='1') == (vocab_file, True)
+    assert no_local_vocab == []
+
+
+def test_hub_fallback_is_opt_in(no_local_vocab, monkeypatch):
+    with pytest.raises(ValueError, match='--vocab_file'):
+        bert_utils.resolve_vocab(gpu_id='1')
+    assert no_local_vocab == []
+
+    monkeypatch.setenv('BERT_VOCAB_FROM_HUB', '1')
+    vocab_file, do_lower_case = bert_utils.resolve_vocab(gpu_id='1')
+    assert vocab_file.endswith('vocab.txt') and do_lower_case
+    assert len(no_local_vocab) == 1
+    assert no_local_vocab[0].gpu_options.visible_device_list == '1'
+    assert no_local_vocab[0].gpu_options.allow_growth
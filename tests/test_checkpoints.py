@@ -0,0 +1,31 @@
+import numpy as np
+
+from utils import latest_checkpoint_epoch, model_checkpoint_callback, tf
+
+
+def _models():
+    inputs = tf.keras.layers.Input(shape=(4,))
+    hidden = tf.keras.layers.Dense(3, name='encoder')(inputs)
+    head = tf.keras.layers.Dense(1, name='head')
+    full_model = tf.keras.Model(inputs=inputs, outputs=head(hidden))
+    head_inputs = tf.keras.layers.Input(shape=(3,))
+    head_model = tf.keras.Model(inputs=head_inputs, outputs=head(head_inputs))
+    return full_model, head_model
+
+
+def test_head_checkpoints_are_found_by_the_phase1_lookup(tmp_path):
+    checkpoint_path = str(tmp_path / 'phase1' / 'cp-{epoch:04d}.ckpt')
+    (tmp_path / 'phase1').mkdir()
+    assert latest_checkpoint_epoch(checkpoint_path, 3) == 0
+
+    full_model, head_model = _models()
+    full_model.compile(loss='mse', optimizer='adam')
+    head_model.compile(loss='mse', optimizer='adam')
+    head_model.fit(np.random.rand(16, 3), np.random.rand(16, 1), epochs=2, verbose=0,
+                   callbacks=[model_checkpoint_callback(full_model, checkpoint_path)])
+    assert latest_checkpoint_epoch(checkpoint_path, 3) == 2
+
+    loaded_model, _ = _models()
+    loaded_model.load_weights(checkpoint_path.format(epoch=2))
+    for weights, loaded_weights in zip(full_model.get_weights(), loaded_model.get_weights()):
+        assert np.array_equal(weights, loaded_weights)
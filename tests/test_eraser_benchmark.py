@@ -0,0 +1,258 @@
+import random
+
+import numpy as np
+import pytest
+
+import eraser_benchmark as E
+
+LABELS = ['SUPPORTS', 'REFUTES']
+RAW_WORDS = ['The', 'cat', 'playing', 'sat,', 'on', 'Mat.', 'Froome', 'É', 'cyclists', '\x00', 'born-1985', 'xyz',
+             'is\xa0a', 'CAT', '\x1c']
+
+
+def _docs(seed):
+    rng = random.Random(seed)
+    return {'d{}'.format(i): [[rng.choice(RAW_WORDS) for _ in range(rng.randint(1, 12))]
+                              for _ in range(rng.randint(1, 4))]
+            for i in range(6)}
+
+
+def _doc_length(docs, docids):
+    return sum(len(sentence) for docid in docids for sentence in docs[docid])
+
+
+def _hard_rationales(docs, num_rationales, seed):
+    rng = random.Random(seed)
+    rationales = []
+    for _ in range(num_rationales):
+        docids = rng.sample(sorted(docs), rng.randint(1, 2))
+        length = _doc_length(docs, docids)
+        spans = []
+        for _ in range(rng.randint(0, 4)):  # overlapping, empty and out of range spans included
+            start = rng.randint(0, length + 2)
+            spans.append({'start_token': start, 'end_token': start + rng.randint(0, 5)})
+        rationales.append({'query': 'Is the cat a cyclist?', 'docids': docids, 'classification': rng.choice(LABELS),
+                           'rationales': [{'hard_rationale_predictions': spans}]})
+    return rationales
+
+
+@pytest.mark.parametrize('max_seq_length', [512, 20])
+def test_fused_counterfactual_features_match_decorators(tokenizer, max_seq_length):
+    docs = _docs(3)
+    rationales = _hard_rationales(docs, 100, 3)
+    fused = E.ce_load_fused_bert_features(rationales, docs, LABELS, max_seq_length, tokenizer)
+    decorated = E.ce_load_bert_features(rationales, docs, LABELS, E.remove_rations, max_seq_length, '0', tokenizer) + \
+        E.ce_load_bert_features(rationales, docs, LABELS, E.extract_rations, max_seq_length, '0', tokenizer)
+    assert [f.__dict__ for f in fused] == [f.__dict__ for f in decorated]
+
+
+def _pieces(tokenizer, text):
+    return [piece for piece, _ in tokenizer.tokenize(text)]
+
+
+def test_counterfactual_pieces_match_decorated_text(tokenizer):
+    docs = _docs(5)
+    doc_pieces = E._DocPieces(docs, tokenizer)
+    sub_pieces = doc_pieces.word('.')
+    for rational in _hard_rationales(docs, 100, 5):
+        text = ' '.join(word for docid in rational['docids'] for sentence in docs[docid] for word in sentence)
+        words_pieces = doc_pieces(rational)
+        assert words_pieces == [_pieces(tokenizer, word) for word in text.lower().split()]
+        spans = rational['rationales'][0]['hard_rationale_predictions']
+        comprehensiveness, sufficiency = E.counterfactual_pieces(words_pieces, spans, sub_pieces)
+        assert comprehensiveness == _pieces(tokenizer, E.remove_rations(text, rational, tokenizer))
+        assert sufficiency == _pieces(tokenizer, E.extract_rations(text, rational, tokenizer))
+
+
+def _soft_rationales(docs, num_rationales, seed):
+    rng = random.Random(seed)
+    rationales = []
+    for _ in range(num_rationales):
+        docid = rng.choice(sorted(docs))
+        soft = [round(rng.random(), 1) for _ in range(_doc_length(docs, [docid]))]  # ties included
+        rationales.append({'query': 'Is the cat a cyclist?', 'docids': [docid], 'classification': 'SUPPORTS',
+                           'rationales': [{'hard_rationale_predictions': [], 'soft_rationale_predictions': soft}]})
+    return rationales
+
+
+def test_top_k_rations():
+    assert E.top_k_rations([0.1, 0.9, 0.9, 0.3, 0.8], 0.5) == [{'start_token': 1, 'end_token': 3},
+                                                              {'start_token': 4, 'end_token': 5}]
+    assert E.top_k_rations([0.1, 0.2], 0.01) == [{'start_token': 1, 'end_token': 2}]
+    assert E.top_k_rations([], 0.5) == []
+
+
+def test_aopc_features_match_per_bin_decorators(tokenizer):
+    docs = _docs(3)
+    rationales = _soft_rationales(docs, 30, 3)
+    fused = E.ce_load_aopc_bert_features(rationales, docs, LABELS, 512, tokenizer, E.AOPC_THRESHOLDS)
+    decorated = []
+    for decorate in (E.remove_rations, E.extract_rations):
+        for threshold in E.AOPC_THRESHOLDS:
+            binned = [dict(rational, rationales=[{'hard_rationale_predictions': E.top_k_rations(
+                rational['rationales'][0]['soft_rationale_predictions'], threshold)}]) for rational in rationales]
+            decorated += E.ce_load_bert_features(binned, docs, LABELS, decorate, 512, '0', tokenizer)
+    assert [f.__dict__ for f in fused] == [f.__dict__ for f in decorated]
+
+
+class _MaskSumModel(object):
+    """Scores an input by its length, so that every bin of every rationale gets its own score."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def predict(self, x, batch_size=None):
+        self.calls += 1
+        return np.asarray(x[1]).sum(axis=1, keepdims=True) / 512.
+
+
+def test_aopc_scores(tokenizer):
+    from eraserbenchmark.rationale_benchmark.utils import Annotation
+    from eraserbenchmark.scoring import score_classifications
+
+    docs = _docs(3)
+    rationales = _soft_rationales(docs, 30, 3)
+    thresholds = E.AOPC_THRESHOLDS
+    model = _MaskSumModel()
+    c, s = E.get_aopc_scores(model, rationales, docs, LABELS, 'fever', 512, 'gru', tokenizer)
+    assert model.calls == 1
+    assert c.shape == s.shape == (len(thresholds), len(rationales), 2)
+
+    for i, threshold in enumerate(thresholds):
+        binned = [dict(rational, rationales=[{'hard_rationale_predictions': E.top_k_rations(
+            rational['rationales'][0]['soft_rationale_predictions'], threshold)}]) for rational in rationales]
+        expected_c, expected_s = E.get_cs_scores(_MaskSumModel(), binned, docs, LABELS, 'fever', 512, 'gru',
+                                                 tokenizer)
+        assert np.array_equal(c[i], expected_c) and np.array_equal(s[i], expected_s)
+
+    results = [E.add_thresholded_scores(dict(rational, annotation_id=str(i),
+                                             classification_scores={'SUPPORTS': 0.3, 'REFUTES': 0.7}),
+                                        thresholds, c[:, i], s[:, i], LABELS)
+               for i, rational in enumerate(rationales)]
+    annotations = [Annotation(annotation_id=str(i), query='', evidences=(), classification='SUPPORTS')
+                   for i in range(len(results))]
+    scores = score_classifications(results, annotations, docs)
+    assert scores['aopc_thresholds'] == thresholds
+    assert scores['comprehensiveness_aopc'] == pytest.approx(np.mean(0.3 - c[:, :, 0]))
+    assert scores['sufficiency_aopc'] == pytest.approx(np.mean(0.3 - s[:, :, 0]))
+    assert scores['comprehensiveness_aopc_points'] == pytest.approx(dict(zip(thresholds, np.mean(0.3 - c[:, :, 0],
+                                                                                                  axis=1))))
+
+
+def _old_rnr_matrix_to_rational_mask(rnr_matrix):
+    # the per-example decoding the batched one replaced
+    start_logits, end_logits = rnr_matrix[:, :1], rnr_matrix[:, 1:]
+    starts = np.round(start_logits).reshape((-1, 1))
+    ends = np.triu(end_logits)
+    ends = starts * ends
+    ends_args = np.argmax(ends, axis=1)
+    ends = np.zeros_like(ends)
+    for i in range(len(ends_args)):
+        ends[i, ends_args[i]] = 1
+    ends = starts * ends
+    ends = np.sum(ends, axis=0, keepdims=True)
+    return np.cumsum(starts.reshape((1, -1)), axis=1) - np.cumsum(ends, axis=1) + ends
+
+
+def _rnr_matrices(num_examples, length, seed):
+    rng = np.random.RandomState(seed)
+    matrices = rng.randn(num_examples, length, length + 1).astype(np.float32)
+    matrices[:, :, 0] = rng.choice([0, 0, 0, 0.7, 1, 1.6, -0.8], (num_examples, length))  # overlapping, weighted
+    matrices[::3, :, 1:] = -np.abs(matrices[::3, :, 1:])  # ends before the start win the argmax
+    matrices[::5] = np.round(matrices[::5])  # ties
+    return matrices
+
+
+def test_rnr_decoding_matches_per_example_loop():
+    matrices = _rnr_matrices(120, 32, 0)
+    expected = np.concatenate([_old_rnr_matrix_to_rational_mask(matrix) for matrix in matrices])
+    assert np.array_equal(E.rnr_matrices_to_rational_masks(matrices), expected)
+    for matrix, mask in zip(matrices[:10], expected):
+        assert np.array_equal(E.rnr_matrix_to_rational_mask(matrix), mask[np.newaxis])
+
+
+class _RnrModel(object):
+    """Returns the rnr matrix of the example whose index is in the first input column, after the cls output."""
+
+    def __init__(self, matrices, with_cls=True):
+        self.matrices = matrices
+        self.with_cls = with_cls
+
+    def predict_on_batch(self, x):
+        matrices = self.matrices[x[0][:, 0].astype(int)]
+        return [x[1][:, :1], matrices] if self.with_cls else matrices
+
+
+@pytest.mark.parametrize('batch_size', [7, 32, 200])
+def test_predict_rnr_rational_masks(batch_size):
+    matrices = _rnr_matrices(120, 32, 1)
+    expected = np.concatenate([_old_rnr_matrix_to_rational_mask(matrix) for matrix in matrices])
+    index = np.arange(len(matrices), dtype=np.float32)[:, np.newaxis].repeat(3, axis=1)
+    inputs = [index, np.random.RandomState(0).rand(len(matrices), 3), np.zeros((len(matrices), 3))]
+    cls_pred, masks = E.predict_rnr_rational_masks(_RnrModel(matrices), inputs, batch_size=batch_size)
+    assert np.array_equal(masks, expected) and np.array_equal(cls_pred, inputs[1][:, :1])
+    masks = E.predict_rnr_rational_masks(_RnrModel(matrices, with_cls=False), inputs, batch_size=batch_size)
+    assert np.array_equal(masks, expected)
+
+
+def _old_pred_to_exp_mask(exp_pred, count=None, threshold=0.5):
+    # the sort based top-k the argpartition one replaced
+    if count is None:
+        return (np.array(exp_pred) >= threshold).astype(np.int32)
+    temp = [(i, p) for i, p in enumerate(exp_pred)]
+    temp = sorted(temp, key=lambda x: x[1], reverse=True)
+    ret = np.zeros_like(exp_pred).astype(np.int32)
+    for i, _ in temp[:count]:
+        ret[i] = 1
+    return ret
+
+
+def _old_rational_bits_to_ev_generator(token_list, docid, exp_pred, hard_selection_count, hard_selection_threshold):
+    # the token by token scan the span extraction replaced
+    in_rationale = False
+    ev = {'docid': docid, 'start_token': -1, 'end_token': -1, 'text': ''}
+    exp_masks = _old_pred_to_exp_mask(exp_pred, hard_selection_count, hard_selection_threshold)
+    for i, p in enumerate(exp_masks):
+        if p == 0 and in_rationale:
+            in_rationale = False
+            ev['end_token'] = i
+            ev['text'] = ' '.join(token_list[ev['start_token']: ev['end_token']])
+            yield dict(ev)
+        elif p == 1 and not in_rationale:
+            in_rationale = True
+            ev['start_token'] = i
+    if in_rationale:
+        ev['end_token'] = len(exp_pred)
+        ev['text'] = ' '.join(token_list[ev['start_token']: ev['end_token']])
+        yield dict(ev)
+
+
+def _old_mask_to_spans(mask):
+    edges = np.diff(np.concatenate([[0], np.asarray(mask, dtype=np.int8), [0]]))
+    return [{'start_token': int(start), 'end_token': int(end)}
+            for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))]
+
+
+def test_exp_masks_and_spans_match_replaced_code(monkeypatch):
+    monkeypatch.setattr(E, 'extract_doc_ids_from_annotations', lambda annotations: ['d0'])
+    rng = np.random.RandomState(0)
+    for _ in range(500):
+        length = rng.randint(0, 60)
+        exp_pred = np.round(rng.rand(length), rng.randint(0, 3)).tolist()  # ties included
+        tokens = ['w{}'.format(i) for i in range(length)]
+        for count in [None, 0, 1, 3, length // 2, length, length + 5]:
+            for threshold in [0.5, 0.3]:
+                assert np.array_equal(E.pred_to_exp_mask(exp_pred, count, threshold),
+                                      _old_pred_to_exp_mask(exp_pred, count, threshold))
+                assert list(E.rational_bits_to_ev_generator(tokens, None, exp_pred, count, threshold)) == \
+                    list(_old_rational_bits_to_ev_generator(tokens, 'd0', exp_pred, count, threshold))
+
+
+def test_masks_to_spans():
+    masks = (np.random.RandomState(1).rand(50, 40) < 0.4).astype(int)
+    masks[0], masks[1] = 0, 1
+    example, start, end = E.masks_to_spans(masks)
+    for i, mask in enumerate(masks):
+        expected = _old_mask_to_spans(mask)
+        assert [{'start_token': s, 'end_token': e} for x, s, e in zip(example, start, end) if x == i] == expected
+        assert E.mask_to_spans(mask) == expected
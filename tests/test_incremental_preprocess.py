@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+import bert_data_preprocessing_rational_eraser as P
+from eraserbenchmark.rationale_benchmark.utils import Annotation, Evidence
+
+full_preprocess = P.preprocess
+
+LABELS = ['SUPPORTS', 'REFUTES']
+DOCS = {'froome': [['Froome', 'is', 'a', 'cyclist', '.'], ['Froome', 'was', 'born', 'in', 'Kenya', '.']],
+        'cat': [['The', 'cat', 'sat', 'on', 'the', 'mat', '.']],
+        'dog': [['The', 'dog', 'is', 'playing', ',', 'the', 'cats', 'sat', '.']]}
+
+
+def _evidence(docid, start, end):
+    return Evidence(text='', docid=docid, start_token=start, end_token=end, start_sentence=-1, end_sentence=-1)
+
+
+def _annotation(annotation_id, query, ev_groups, label='SUPPORTS'):
+    return Annotation(annotation_id=annotation_id, query=query, evidences=tuple(ev_groups), classification=label,
+                      docids=None)
+
+
+def _data():
+    return [_annotation('a0', 'Froome is a cyclist', [(_evidence('froome', 0, 4),), (_evidence('froome', 5, 10),)]),
+            _annotation('a1', 'the cat sat', [(_evidence('cat', 1, 3),)], 'REFUTES'),
+            _annotation('a2', 'the dog', [(_evidence('dog', 0, 2), _evidence('dog', 5, 7))]),
+            _annotation('a3', 'who was born in Kenya', [(_evidence('froome', 7, 10),)])]
+
+
+def _assert_same(rets, expected):
+    assert len(rets) == len(expected)
+    for field, expected_field in zip(rets, expected):
+        if expected_field is None:
+            assert field is None
+        else:
+            assert field.dtype == expected_field.dtype
+            assert np.array_equal(field, expected_field)
+
+
+def _preprocess(data, merge_evidences):
+    return full_preprocess(data, DOCS, LABELS, 'fever', 512, 'gru', merge_evidences)
+
+
+def _incremental(data, merge_evidences, row_store_dir):
+    return P.preprocess_incremental(data, DOCS, LABELS, 'fever', 512, 'gru', merge_evidences, row_store_dir)
+
+
+@pytest.fixture
+def tokenized(monkeypatch, vocab_file):
+    """Records the annotations preprocess_incremental has to tokenize, with their number of evidence groups."""
+    calls = []
+
+    def recording_preprocess(data, *args, **kwargs):
+        calls.append([(ann.annotation_id, len(ann.evidences)) for ann in data])
+        return full_preprocess(data, *args, **kwargs)
+
+    monkeypatch.setattr(P, 'preprocess', recording_preprocess)
+    return calls
+
+
+@pytest.mark.parametrize('merge_evidences', [False, True])
+def test_incremental_matches_full_preprocess(tmp_path, tokenized, merge_evidences):
+    row_store_dir = str(tmp_path / 'rows')
+    data = _data()
+    _assert_same(_incremental(data, merge_evidences, row_store_dir), _preprocess(data, merge_evidences))
+    assert tokenized == [[('a0', 2), ('a1', 1), ('a2', 1), ('a3', 1)]]
+
+    # unchanged: nothing is tokenized again
+    _assert_same(_incremental(data, merge_evidences, row_store_dir), _preprocess(data, merge_evidences))
+    assert len(tokenized) == 1
+
+    # one changed, one removed, one added
+    edited = [_annotation('a1', 'the cat sat on the mat', [(_evidence('cat', 1, 6),)], 'REFUTES'),
+              data[0], data[3], _annotation('a4', 'the dog is playing', [(_evidence('dog', 0, 4),)])]
+    _assert_same(_incremental(edited, merge_evidences, row_store_dir), _preprocess(edited, merge_evidences))
+    assert tokenized[-1] == [('a1', 1), ('a4', 1)]
+
+
+@pytest.mark.parametrize('merge_evidences', [False, True])
+def test_row_keys_do_not_depend_on_evidence_order(merge_evidences):
+    ann = _data()[0]
+    reordered = _annotation('a0', ann.query, list(ann.evidences)[::-1])
+    keys, reordered_keys = P.row_keys([ann], DOCS, merge_evidences), P.row_keys([reordered], DOCS, merge_evidences)
+    if merge_evidences:
+        assert keys == reordered_keys
+    else:
+        assert keys == reordered_keys[::-1] and len(set(keys)) == 2
+
+
+@pytest.mark.parametrize('merge_evidences', [False, True])
+def test_reordered_evidences_reuse_the_stored_rows(tmp_path, tokenized, merge_evidences):
+    row_store_dir = str(tmp_path / 'rows')
+    data = _data()
+    first = _incremental(data, merge_evidences, row_store_dir)
+    reordered = [_annotation('a0', data[0].query, list(data[0].evidences)[::-1])] + data[1:]
+    rows = _incremental(reordered, merge_evidences, row_store_dir)
+    assert len(tokenized) == 1
+    # a merged row is served as first stored, otherwise the rows follow the new order of the groups
+    _assert_same(rows, first if merge_evidences else _preprocess(reordered, merge_evidences))
+
+
+def test_only_changed_evidence_groups_are_tokenized(tmp_path, tokenized):
+    row_store_dir = str(tmp_path / 'rows')
+    data = _data()
+    _incremental(data, False, row_store_dir)
+    first_group = list(data[0].evidences)[0]
+    edited = [_annotation('a0', data[0].query, [first_group, (_evidence('froome', 6, 9),)])] + data[1:]
+    _assert_same(_incremental(edited, False, row_store_dir), _preprocess(edited, False))
+    assert tokenized[-1] == [('a0', 1)]
+
+
+def test_empty_split(tmp_path, vocab_file):
+    rets = _incremental([], False, str(tmp_path / 'rows'))
+    _assert_same(rets, P.convert_bert_features([], True, True, 'gru'))
+    assert rets[0].shape == (0, 512)
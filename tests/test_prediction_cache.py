@@ -0,0 +1,47 @@
+import os
+import time
+
+import numpy as np
+
+from prediction_cache import STALE_TMP_SECONDS, PredictionCache, evict_lru
+from shortcut_evaluation import _soft_rationales
+
+
+def test_put_get_and_evict_lru(tmp_path):
+    cache = PredictionCache(str(tmp_path), 'ckpt-1')
+    value = {'label': 'SUPPORTS', 'probabilities': [0.9, 0.1], 'soft_rationale': [0.5] * 50}
+    cache.put(['Froome', 'is', 'a', 'cyclist'], 'Froome  was born in Kenya .', value)
+    assert cache.get('Froome is a  cyclist', ['Froome', 'was', 'born', 'in', 'Kenya', '.']) == value
+    assert PredictionCache(str(tmp_path), 'ckpt-2').get('Froome is a cyclist', 'Froome was born in Kenya .') is None
+
+    for i in range(4):
+        cache.put('query {}'.format(i), 'evidence', value)
+    paths = {i: cache._path(cache.key('query {}'.format(i), 'evidence')) for i in range(4)}
+    for i, path in paths.items():
+        os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+    cache.get('query 0', 'evidence')  # most recently used now
+    entry_size = os.path.getsize(paths[0])
+    evict_lru(str(tmp_path), 3 * entry_size)
+    assert [os.path.exists(paths[i]) for i in range(4)] == [True, False, False, True]
+
+
+def test_soft_rationales_are_trimmed_to_each_row():
+    exp_pred = np.arange(12, dtype=np.float32).reshape(2, 6) / 10
+    rationales = _soft_rationales({'mtl_preds': {'exp_pred': exp_pred}}, [6, 3])
+    assert rationales == [list(map(float, exp_pred[0])), list(map(float, exp_pred[1, :3]))]
+    assert _soft_rationales({'mtl_preds': {}}, [6, 3]) == [None, None]
+
+
+def test_evict_lru_deletes_stale_tmp_files(tmp_path):
+    cache = PredictionCache(str(tmp_path), 'ckpt-1')
+    cache.put('query', 'evidence', {'label': 'SUPPORTS'})
+    entry = cache._path(cache.key('query', 'evidence'))
+    stale, fresh = entry + '.1.tmp', entry + '.2.tmp'  # left by an interrupted put, and being written
+    for path in (stale, fresh):
+        with open(path, 'wb') as fout:
+            fout.write(b'0' * 1000)
+    old = time.time() - STALE_TMP_SECONDS - 1
+    os.utime(stale, (old, old))
+    assert evict_lru(str(tmp_path), 1 << 20) == 1000
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh) and os.path.exists(entry)
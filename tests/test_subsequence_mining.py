@@ -0,0 +1,58 @@
+from collections import Counter
+from itertools import product
+
+from subsequence_mining import iter_discriminative_patterns, mine_frequent_subsequences, tokenize_claim
+
+CLAIMS = ['Froome is a cyclist.', 'Froome is not a cyclist.', 'The cat is not a dog.', 'The cat is a cat.',
+          'Kenya is only a country.', 'The dog is only a dog.', 'Froome was born in Kenya.',
+          "Froome wasn't born in Kenya.", 'The cat has yet to be a dog.', 'The dog is not only a cat.']
+LABELS = ['SUPPORTS', 'REFUTES', 'SUPPORTS', 'SUPPORTS', 'REFUTES', 'REFUTES', 'SUPPORTS', 'REFUTES', 'REFUTES',
+          'REFUTES']
+
+
+def _occurs(pattern, seq, max_gap):
+    # brute force: any embedding with at most max_gap tokens between consecutive items
+    def from_pos(i, pos):
+        if i == len(pattern):
+            return True
+        if seq[pos] != pattern[i]:
+            return False
+        return i + 1 == len(pattern) or any(from_pos(i + 1, nxt)
+                                            for nxt in range(pos + 1, min(len(seq), pos + max_gap + 2)))
+    return any(from_pos(0, pos) for pos in range(len(seq)))
+
+
+def _brute_force(sequences, min_support, max_gap, max_length):
+    vocab = sorted(set(item for seq in sequences for item in seq))
+    patterns = dict()
+    for length in range(1, max_length + 1):
+        for pattern in product(vocab, repeat=length):
+            seq_ids = [i for i, seq in enumerate(sequences) if _occurs(pattern, seq, max_gap)]
+            if len(seq_ids) >= min_support:
+                patterns[pattern] = seq_ids
+    return patterns
+
+
+def test_miner_matches_brute_force():
+    sequences = [tokenize_claim(claim) for claim in CLAIMS]
+    for max_gap in (0, 1, 2):
+        assert mine_frequent_subsequences(sequences, 2, max_gap, 3) == _brute_force(sequences, 2, max_gap, 3)
+
+
+def test_discriminative_patterns_count_gold_labels():
+    sequences = [tokenize_claim(claim) for claim in CLAIMS]
+    frequent = _brute_force(sequences, 2, 1, 3)
+    mined = {stats['pattern']: stats for stats in iter_discriminative_patterns(sequences, LABELS, 2, 1, 3)}
+    assert set(mined) == set(' '.join(pattern) for pattern in frequent)
+    for pattern, seq_ids in frequent.items():
+        stats = mined[' '.join(pattern)]
+        support = Counter(LABELS[i] for i in seq_ids)
+        assert stats['support'] == len(seq_ids)
+        assert stats['label_support'] == {label: support.get(label, 0) for label in ('SUPPORTS', 'REFUTES')}
+        assert stats['label_confidence'] == support[stats['prediction_class']] / len(seq_ids) == \
+            max(support.values()) / len(seq_ids)
+
+    xor = {stats['pattern'] for stats in iter_discriminative_patterns(sequences, LABELS, 2, 1, 3, xor=True)}
+    assert xor == {' '.join(pattern) for pattern, seq_ids in frequent.items()
+                   if sum(count >= 2 for count in Counter(LABELS[i] for i in seq_ids).values()) == 1}
+    assert 'is only' in xor and 'is a' not in xor
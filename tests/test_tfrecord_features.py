@@ -0,0 +1,38 @@
+import numpy as np
+
+from tfrecord_features import tf, tfrecord_dataset, write_tfrecord_split
+
+
+def _split(num_examples, max_seq_length, seed=0):
+    random_state = np.random.RandomState(seed)
+    lengths = random_state.randint(3, max_seq_length + 1, size=num_examples)
+    input_masks = (np.arange(max_seq_length) < lengths[:, None]).astype(np.uint8)
+    input_ids = (random_state.randint(1, 100, size=input_masks.shape) * input_masks).astype(np.uint16)
+    segment_ids = np.zeros_like(input_masks)
+    rations = np.packbits(random_state.randint(0, 2, size=input_masks.shape) * input_masks, axis=-1)
+    labels = random_state.randint(0, 2, size=(num_examples, 1)).astype(np.uint8)
+    return [input_ids, input_masks, segment_ids, rations, labels]
+
+
+def _batches(dataset, num_batches):
+    next_batch = tf.data.make_one_shot_iterator(dataset).get_next()
+    with tf.Session() as sess:
+        return [sess.run(next_batch) for _ in range(num_batches)]
+
+
+def test_val_dataset_repeats_the_same_batches_every_pass(tmp_path):
+    split = _split(23, 16)
+    write_tfrecord_split(split, str(tmp_path), 'val', num_shards=3, max_seq_length=16)
+    dataset, num_batches = tfrecord_dataset(str(tmp_path), 'val', ['cls_output', 'exp_output'], 4,
+                                            bucket_lengths=[8, 16], max_seq_length=16, cycle_length=1)
+    batches = _batches(dataset, 3 * num_batches)
+    first_pass = batches[:num_batches]
+    for other_pass in (batches[num_batches: 2 * num_batches], batches[2 * num_batches:]):
+        for (x, y), (other_x, other_y) in zip(first_pass, other_pass):
+            for tensor, other_tensor in zip(x, other_x):
+                assert np.array_equal(tensor, other_tensor)
+            assert np.array_equal(y['exp_output'], other_y['exp_output'])
+
+    input_ids = sorted(tuple(row[row > 0]) for (x, _) in first_pass for row in x[0].astype(int))
+    assert input_ids == sorted(tuple(row[row > 0]) for row in split[0].astype(int))
+    assert sum(len(y['cls_output']) for _, y in first_pass) == 23
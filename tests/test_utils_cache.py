@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+
+from utils import content_cache_key, dump_npy_shards, evict_cache_entries, load_npy_manifest, load_npy_shards
+
+
+def _dump_entry(cache_root, name, size, last_used):
+    dump_dir = os.path.join(cache_root, name)
+    dump_npy_shards([[np.zeros(size, dtype=np.int8)]], dump_dir, ['train'], ['input_ids'])
+    os.utime(os.path.join(dump_dir, 'manifest.json'), (last_used, last_used))
+    return dump_dir
+
+
+def test_content_cache_key(tmp_path):
+    data = tmp_path / 'train.jsonl'
+    data.write_text('a')
+    key = content_cache_key([str(data)], {'max_seq_length': 512}, 1)
+    assert key == content_cache_key([str(data)], {'max_seq_length': 512}, 1)
+    assert key != content_cache_key([str(data)], {'max_seq_length': 256}, 1)
+    assert key != content_cache_key([str(data)], {'max_seq_length': 512}, 2)
+    data.write_text('b')
+    assert key != content_cache_key([str(data)], {'max_seq_length': 512}, 1)
+
+
+def test_dump_and_load_npy_shards(tmp_path):
+    dump_dir = str(tmp_path / 'entry')
+    rets = [[np.arange(6).reshape((2, 3)), None], [np.ones((1, 3)), np.array([[1]])]]
+    dump_npy_shards(rets, dump_dir, ['train', 'test'], ['input_ids', 'labels'], extra={'n': 1})
+    loaded = load_npy_shards(dump_dir)
+    assert np.array_equal(loaded[0][0], rets[0][0]) and loaded[0][1] is None
+    assert np.array_equal(loaded[1][1], rets[1][1])
+    assert load_npy_manifest(dump_dir)['extra'] == {'n': 1}
+    assert os.listdir(str(tmp_path)) == ['entry']
+
+
+def test_dump_npy_shards_keeps_existing_entry_unless_replaced(tmp_path):
+    dump_dir = str(tmp_path / 'entry')
+    dump_npy_shards([[np.zeros(3)]], dump_dir, ['train'], ['input_ids'])
+    dump_npy_shards([[np.ones(3)]], dump_dir, ['train'], ['input_ids'])
+    assert np.array_equal(load_npy_shards(dump_dir)[0][0], np.zeros(3))
+    dump_npy_shards([[np.ones(3)]], dump_dir, ['train'], ['input_ids'], replace=True)
+    assert np.array_equal(load_npy_shards(dump_dir)[0][0], np.ones(3))
+    assert os.listdir(str(tmp_path)) == ['entry']
+
+
+def test_evict_cache_entries_lru(tmp_path):
+    cache_root = str(tmp_path)
+    oldest = _dump_entry(cache_root, 'a', 1000, 100)
+    kept = _dump_entry(cache_root, 'b', 1000, 200)
+    newest = _dump_entry(cache_root, 'c', 1000, 300)
+    evict_cache_entries(cache_root, 3000, keep=[kept])
+    assert not os.path.exists(oldest)
+    assert os.path.exists(kept) and os.path.exists(newest)
+    evict_cache_entries(cache_root, 2000, keep=[kept])
+    assert os.path.exists(kept) and not os.path.exists(newest)
+
+
+def test_evict_cache_entries_skips_unfinished_entries(tmp_path):
+    cache_root = str(tmp_path)
+    # being written by another process: a tmp directory, and a directory without a manifest yet
+    tmp_dir = tmp_path / 'a.tmp1234'
+    tmp_dir.mkdir()
+    (tmp_dir / 'train.input_ids.npy').write_bytes(b'0' * 10000)
+    partial = tmp_path / 'b'
+    partial.mkdir()
+    (partial / 'train.input_ids.npy').write_bytes(b'0' * 10000)
+    os.utime(str(tmp_dir), (1, 1))
+    os.utime(str(partial), (1, 1))
+    entry = _dump_entry(cache_root, 'c', 1000, 100)
+    evict_cache_entries(cache_root, 0)
+    assert tmp_dir.exists() and partial.exists()
+    assert not os.path.exists(entry)
+
+
+def test_evict_cache_entries_shares_the_limit_with_row_stores(tmp_path):
+    cache_root, rows_root = str(tmp_path / 'cache'), str(tmp_path / 'rows')
+    entry = _dump_entry(cache_root, 'a', 1000, 300)
+    # a row store entry holds one store per split
+    old_rows = os.path.join(rows_root, 'fever_1')
+    _dump_entry(old_rows, 'train', 1000, 100)
+    _dump_entry(old_rows, 'val', 1000, 200)
+    new_rows = os.path.join(rows_root, 'fever_2')
+    _dump_entry(new_rows, 'train', 1000, 400)
+    (tmp_path / 'rows' / 'fever_2' / 'val.tmp1234').mkdir()  # being written
+    evict_cache_entries([cache_root, rows_root], 2500)
+    assert not os.path.exists(old_rows)
+    assert os.path.exists(entry) and os.path.exists(new_rows)
+    evict_cache_entries([cache_root, rows_root], 0)
+    assert not os.path.exists(entry) and os.path.exists(new_rows)
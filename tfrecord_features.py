@@ -0,0 +1,173 @@
+import argparse
+import json
+
+import numpy as np
+import os
+import tensorflow.compat.v1 as tf
+
+tf.disable_v2_behavior()
+
+FIELD_NAMES = ['input_ids', 'input_masks', 'segment_ids', 'rations', 'labels']
+
+
+def _int64_list(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[int(v) for v in values]))
+
+
+def shard_fname(split_name, shard_id, num_shards):
+    return '{}-{:05d}-of-{:05d}.tfrecord.gz'.format(split_name, shard_id, num_shards)
+
+
+def write_tfrecord_split(split, output_dir, split_name, num_shards=8, max_seq_length=512):
+    """Writes one split of preprocessed features to num_shards GZIP compressed TFRecord files.
+
+    split is [input_ids, input_masks, segment_ids, packed rations, labels] as returned by
+    bert_data_preprocessing_rational_eraser.preprocess (rations or labels may be None). Every example is stored
+    without its padding; tfrecord_dataset pads it again. A '<split_name>.json' manifest lists the shards, the
+    stored fields and the histogram of example lengths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    input_ids, input_masks, segment_ids, rations, labels = split
+    fields = [name for name, field in zip(FIELD_NAMES, split) if field is not None]
+    lengths = np.asarray(input_masks).sum(axis=1).astype(np.int64)
+    options = tf.io.TFRecordOptions(compression_type='GZIP')
+    shards = []
+    for shard_id, rows in enumerate(np.array_split(np.arange(len(lengths)), num_shards)):
+        fname = shard_fname(split_name, shard_id, num_shards)
+        tmp_fname = os.path.join(output_dir, fname + '.tmp')
+        with tf.io.TFRecordWriter(tmp_fname, options=options) as writer:
+            for i in rows:
+                length = lengths[i]
+                feature = {'input_ids': _int64_list(input_ids[i][:length]),
+                           'input_masks': _int64_list(input_masks[i][:length]),
+                           'segment_ids': _int64_list(segment_ids[i][:length])}
+                if rations is not None:
+                    feature['rations'] = _int64_list(np.unpackbits(rations[i])[:length])
+                if labels is not None:
+                    feature['labels'] = _int64_list(labels[i])
+                writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+        os.replace(tmp_fname, os.path.join(output_dir, fname))
+        shards.append(fname)
+    manifest = {'split': split_name,
+                'num_examples': len(lengths),
+                'max_seq_length': max_seq_length,
+                'shards': shards,
+                'fields': fields,
+                'length_counts': np.bincount(lengths, minlength=max_seq_length + 1).tolist()}
+    with open(os.path.join(output_dir, split_name + '.json'), 'w') as fout:
+        json.dump(manifest, fout)
+    return manifest
+
+
+def load_tfrecord_manifest(tfrecord_dir, split_name):
+    with open(os.path.join(tfrecord_dir, split_name + '.json'), 'r') as fin:
+        return json.load(fin)
+
+
+def _parse_example(fields):
+    feature_spec = {name: tf.io.VarLenFeature(tf.int64) for name in fields}
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, feature_spec)
+        return {name: tf.sparse.to_dense(example[name]) for name in fields}
+
+    return parse
+
+
+def _rations_targets(rations, exp_output):
+    # same targets as bert_data_preprocessing_rational_eraser.unpack_rations, on a padded batch
+    rations = tf.cast(rations, tf.int32)
+    if exp_output != 'interval':
+        return tf.expand_dims(rations, -1)
+    rations = tf.pad(rations, [[0, 0], [1, 1]])
+    rations = rations[:, 1:] - rations[:, :-1]
+    rations_start = tf.cast(rations[:, :-1] > 0, tf.int32)
+    rations_end = tf.cast(rations[:, 1:] < 0, tf.int32)
+    return tf.stack([rations_start, rations_end], axis=-1)
+
+
+def tfrecord_dataset(tfrecord_dir, split_name, output_names, batch_size, exp_output='gru', shuffle=False,
+                     bucket_lengths=None, max_seq_length=512, cycle_length=8, shuffle_buffer=10000, seed=None):
+    """Reads a split written by write_tfrecord_split as ((input_ids, input_masks, segment_ids), targets) batches.
+
+    The shards are read in parallel and interleaved. Batches are padded to max_seq_length, or, with
+    bucket_lengths, grouped by example length and padded to their bucket length as in bucketing. output_names
+    are model output names as in input_pipeline.feature_dataset. The dataset repeats forever like
+    feature_dataset's: training streams (shuffle set) over reshuffled shards, other splits pass by pass, each
+    pass yielding the same batches. Returns (dataset, batches per pass over the split).
+    """
+    manifest = load_tfrecord_manifest(tfrecord_dir, split_name)
+    single_output = isinstance(output_names, str)
+    if single_output:
+        output_names = [output_names]
+    if bucket_lengths is None:
+        bucket_lengths = [max_seq_length]
+    length_counts = np.cumsum(manifest['length_counts'])
+    bucket_sizes = np.diff([0] + [length_counts[min(length, len(length_counts) - 1)] for length in bucket_lengths])
+    num_batches = int(sum(np.ceil(bucket_sizes / batch_size)))
+
+    files = tf.data.Dataset.from_tensor_slices([os.path.join(tfrecord_dir, fname) for fname in manifest['shards']])
+    if shuffle:
+        files = files.shuffle(len(manifest['shards']), seed=seed).repeat()
+    dataset = files.interleave(lambda fname: tf.data.TFRecordDataset(fname, compression_type='GZIP'),
+                               cycle_length=cycle_length,
+                               num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+    dataset = dataset.map(_parse_example(manifest['fields']), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    boundaries = tf.constant(bucket_lengths, dtype=tf.int64)
+
+    def bucket_id(example):
+        return tf.reduce_sum(tf.cast(tf.size(example['input_ids'], out_type=tf.int64) > boundaries, tf.int64))
+
+    def batch_bucket(key, examples):
+        length = tf.reshape(tf.gather(boundaries, key), [1])
+        padded_shapes = {name: (tf.constant([1], tf.int64) if name == 'labels' else length)
+                         for name in manifest['fields']}
+        return examples.padded_batch(batch_size, padded_shapes=padded_shapes)
+
+    dataset = dataset.apply(tf.data.experimental.group_by_window(bucket_id, batch_bucket, window_size=batch_size))
+    if not shuffle:
+        # repeated after batching, so that no batch straddles two passes and every pass has num_batches
+        dataset = dataset.repeat()
+
+    input_length = max_seq_length if len(bucket_lengths) == 1 else None
+
+    def to_model_io(batch):
+        x = []
+        for name in FIELD_NAMES[:3]:
+            tensor = tf.cast(batch[name], tf.float32)
+            tensor.set_shape([None, input_length])
+            x.append(tensor)
+        y = []
+        for name in output_names:
+            if name == 'cls_output':
+                y.append(tf.cast(batch['labels'], tf.float32))
+            else:
+                targets = tf.cast(_rations_targets(batch['rations'], exp_output), tf.float32)
+                targets.set_shape([None, input_length, 2 if exp_output == 'interval' else 1])
+                y.append(targets)
+        if single_output:
+            return tuple(x), y[0]
+        return tuple(x), dict(zip(output_names, y))
+
+    dataset = dataset.map(to_model_io, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset, num_batches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feature_dir', type=str, required=True)  # a preprocessing cache dir of bert_cls_exp_gen
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--num_shards', type=int, default=8)
+    parser.add_argument('--max_seq_length', type=int, default=512)
+    args = parser.parse_args()
+
+    from utils import load_npy_manifest, load_npy_shards
+
+    split_names = load_npy_manifest(args.feature_dir)['splits']
+    for split_name, split in zip(split_names, load_npy_shards(args.feature_dir)):
+        manifest = write_tfrecord_split(split, args.output_dir, split_name, args.num_shards, args.max_seq_length)
+        print('{}: {} examples in {} shards'.format(split_name, manifest['num_examples'], len(manifest['shards'])))
@@ -1,5 +1,10 @@
+import hashlib
+import json
 import pickle
+import shutil
+import time
 
+import numpy as np
 import os
 import re
 import tensorflow
@@ -54,6 +59,158 @@ def cache_decorator(*dump_fnames, force_recache=False):
     return excution_decorator
 
 
+def _hash_path(path, hasher):
+    # files are hashed by content; directories (e.g. the movies 'docs' folder) by their listing, sizes and mtimes
+    if os.path.isdir(path):
+        for fname in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, fname))
+            hasher.update('{} {} {}\n'.format(fname, stat.st_size, stat.st_mtime_ns).encode('utf8'))
+    elif os.path.isfile(path):
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                hasher.update(block)
+    else:
+        hasher.update(b'<missing>')
+
+
+def content_cache_key(paths, settings, version):
+    """A key that changes whenever one of the input files, the settings or the code version changes."""
+    hasher = hashlib.sha1()
+    hasher.update('version {}\n'.format(version).encode('utf8'))
+    hasher.update(json.dumps(settings, sort_keys=True, default=str).encode('utf8'))
+    for path in paths:
+        hasher.update('\n{}\n'.format(os.path.basename(path)).encode('utf8'))
+        _hash_path(path, hasher)
+    return hasher.hexdigest()[:16]
+
+
+def _entry_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, fname))
+               for root, _, fnames in os.walk(path) for fname in fnames)
+
+
+def _entry_manifests(path):
+    # an entry is a shard directory, or a directory of them such as a row store with one per split
+    manifest = os.path.join(path, 'manifest.json')
+    if os.path.isfile(manifest):
+        return [manifest]
+    if not os.path.isdir(path):
+        return []
+    fnames = os.listdir(path)
+    if any('.tmp' in fname for fname in fnames):  # a split being written
+        return []
+    return [os.path.join(path, fname, 'manifest.json') for fname in fnames
+            if os.path.isfile(os.path.join(path, fname, 'manifest.json'))]
+
+
+def evict_cache_entries(cache_roots, max_bytes, keep=()):
+    """Deletes whole cache entries (shard directories, or directories of them) under the cache_roots, least
+    recently used first, until the entries of all roots together take at most max_bytes. Paths in keep are never
+    deleted, and neither are entries without a manifest or '<key>.tmp<pid>' directories, which other processes
+    may still be writing."""
+    if isinstance(cache_roots, str):
+        cache_roots = [cache_roots]
+    entries = []
+    for cache_root in cache_roots:
+        if not os.path.isdir(cache_root):
+            continue
+        for fname in os.listdir(cache_root):
+            path = os.path.join(cache_root, fname)
+            if '.tmp' in fname:
+                continue
+            try:
+                manifests = _entry_manifests(path)
+                if len(manifests) == 0:
+                    continue
+                entries.append((max(os.path.getmtime(manifest) for manifest in manifests), path, _entry_size(path)))
+            except OSError:  # evicted or replaced by another process meanwhile
+                continue
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in [os.path.abspath(k) for k in keep]:
+            continue
+        print('evicting preprocessing cache {}'.format(path))
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def load_npy_manifest(dump_dir):
+    with open(os.path.join(dump_dir, 'manifest.json'), 'r') as fin:
+        return json.load(fin)
+
+
+def load_npy_shards(dump_dir):
+    manifest_fname = os.path.join(dump_dir, 'manifest.json')
+    manifest = load_npy_manifest(dump_dir)
+    now = time.time()
+    os.utime(manifest_fname, (now, now))  # last access, for evict_cache_entries
+    rets = []
+    for split_name in manifest['splits']:
+        fields = manifest['fields'][split_name]
+        rets.append([None if fname is None else np.load(os.path.join(dump_dir, fname), mmap_mode='r')
+                     for fname in fields])
+    return tuple(rets)
+
+
+def dump_npy_shards(rets, dump_dir, split_names, field_names, extra=None, replace=False):
+    """Writes the shards to a private directory and renames it to dump_dir, so readers never see a half written
+    cache. If dump_dir exists already (e.g. another process built the same entry meanwhile) it is kept, unless
+    replace is set."""
+    tmp_dir = '{}.tmp{}'.format(dump_dir, os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    manifest = {'splits': list(split_names), 'field_names': list(field_names), 'fields': {}, 'extra': extra}
+    for split_name, split in zip(split_names, rets):
+        manifest['fields'][split_name] = []
+        for field_name, field in zip(field_names, split):
+            if field is None:
+                manifest['fields'][split_name].append(None)
+                continue
+            fname = '{}.{}.npy'.format(split_name, field_name)
+            np.save(os.path.join(tmp_dir, fname), np.asarray(field))
+            manifest['fields'][split_name].append(fname)
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fout:
+        json.dump(manifest, fout, indent=2)
+    try:
+        os.rename(tmp_dir, dump_dir)
+    except OSError:  # dump_dir exists and is not empty
+        old_dir = '{}.tmp{}.old'.format(dump_dir, os.getpid())
+        if replace:
+            try:
+                os.rename(dump_dir, old_dir)
+            except OSError:  # moved away by another process
+                pass
+        try:
+            os.rename(tmp_dir, dump_dir)
+        except OSError:  # lost the race against another writer, whose complete entry is kept
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def npy_cache_decorator(dump_dir, split_names, field_names, force_recache=False):
+    """Like cache_decorator for functions returning one list of arrays per split, but every split and field
+    is stored as its own .npy shard next to a small JSON manifest, and loaded memory-mapped.
+
+    Loading is near-instant, only the pages a run actually reads are brought in, and the processes of a
+    sweep share them through the page cache.
+    """
+    def excution_decorator(func):
+        def wrapper(*args, **kwargs):
+            if not os.path.isfile(os.path.join(dump_dir, 'manifest.json')) or force_recache:
+                rets = func(*args, **kwargs)
+                dump_npy_shards(rets, dump_dir, split_names, field_names, replace=force_recache)
+            return load_npy_shards(dump_dir)
+
+        return wrapper
+
+    return excution_decorator
+
+
 def convert_ids_to_token_list(input_ids, vocab=None):
     iv_vocab = {input_id: wordpiece for wordpiece, input_id in vocab.items()}
     token_list = convert_ids_to_tokens(iv_vocab, input_ids)
@@ -90,3 +247,18 @@ def mkdirs(path):
         tf.io.gfile.makedirs(path)
     else:
         tf.gfile.MakeDirs(path)
+
+
+def latest_checkpoint_epoch(checkpoint_path, num_epochs):
+    """The last epoch up to num_epochs with a checkpoint file at checkpoint_path.format(epoch=...), 0 if none."""
+    for epoch in range(num_epochs, 0, -1):
+        if os.path.isfile(checkpoint_path.format(epoch=epoch)):
+            return epoch
+    return 0
+
+
+def model_checkpoint_callback(model, checkpoint_path):
+    """Saves model after every epoch as ModelCheckpoint(checkpoint_path, save_weights_only=False) saves the model
+    being fit, one HDF5 file per epoch, for when another model sharing its layers is fit instead."""
+    return tf.keras.callbacks.LambdaCallback(
+        on_epoch_end=lambda epoch, logs: model.save(checkpoint_path.format(epoch=epoch + 1), save_format='h5'))